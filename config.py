@@ -14,12 +14,32 @@ def parse_args():
                         default='./prepare_dataset/data_path_list/STARE/train.txt')
     parser.add_argument('--test_data_path_list',
                         default='./prepare_dataset/data_path_list/STARE/test.txt')
+    parser.add_argument('--cache_dir', default='./cache',
+                        help='directory of the preprocessed data cache, set to empty string to disable')
+    parser.add_argument('--preproc_workers', default=None, type=int,
+                        help='number of threads decoding and preprocessing the images (default: one per CPU core)')
     parser.add_argument('--train_patch_height', default=64)
     parser.add_argument('--train_patch_width', default=64)
     parser.add_argument('--N_patches', default=150000,
                         help='Number of training image patches')
+    parser.add_argument('--patch_store', default=None,
+                        help='directory of memory-mapped patch shards used by get_dataloader (patches are kept in memory if not set)')
+    parser.add_argument('--patch_shard_size', default=10000, type=int,
+                        help='number of patches per shard of the patch store')
+    parser.add_argument('--lazy_images', default=False, type=bool,
+                        help='get_dataloaderV2 loads and preprocesses the training images on demand, for data sets larger than the memory')
+    parser.add_argument('--image_cache_mb', default=1024, type=float,
+                        help='size in MB of the cache of preprocessed images of each loader worker (lazy_images only)')
+    parser.add_argument('--images_per_group', default=8, type=int,
+                        help='with lazy_images, the patches are drawn from groups of this many images at a time')
     parser.add_argument('--inside_FOV', default='center',
                         help='Choose from [not,center,all]')
+    parser.add_argument('--sampling', default='uniform', choices=['uniform', 'stratified'],
+                        help='patch center sampling of get_dataloaderV2, stratified draws a fixed ratio of patches by vessel density')
+    parser.add_argument('--strata_ratio', default=[0.4, 0.3, 0.3], type=float, nargs=3,
+                        help='ratio of vessel-rich, mixed and background patches for stratified sampling')
+    parser.add_argument('--density_thresholds', default=[0.15, 0.03], type=float, nargs=2,
+                        help='vessel pixel fraction above which a patch is vessel-rich, and below which it is background')
     parser.add_argument('--val_ratio', default=0.1,
                         help='The ratio of the validation set in the training set')
     parser.add_argument('--sample_visualization', default=True,
@@ -37,6 +57,18 @@ def parse_args():
                         type=int, help='batch size')
     parser.add_argument('--early-stop', default=6, type=int,
                         help='early stopping')
+    parser.add_argument('--batch_aug', default=True, type=bool,
+                        help='augment (crop, flip, rotate) whole batches on the device instead of each sample in the loader')
+    parser.add_argument('--batch_gather', default=True, type=bool,
+                        help='get_dataloaderV2 slices all patches of a batch in one vectorized call')
+    parser.add_argument('--dataloader', default='V2', choices=['V1', 'V2', 'stream'],
+                        help='V1: extract all patches in advance, V2: index of patch positions, stream: fresh patch positions every epoch')
+    parser.add_argument('--stream_epoch_len', default=None, type=int,
+                        help='number of training patches per epoch of the stream dataloader, (1-val_ratio)*N_patches by default')
+    parser.add_argument('--stream_chunk_size', default=8192, type=int,
+                        help='number of patch positions the stream dataloader draws at once')
+    parser.add_argument('--num_workers', default=4, type=int,
+                        help='number of DataLoader worker processes of get_dataloaderV2')
     parser.add_argument('--lr', default=0.0005, type=float,
                         help='initial learning rate')
     parser.add_argument('--val_on_test', default=False, type=bool,
@@ -49,10 +81,38 @@ def parse_args():
                         help='(path of trained _model)load trained model to continue train')
 
     # testing
+    parser.add_argument('--test_mode', default='patch', choices=['patch', 'stream', 'whole'],
+                        help='patch: predict the patches of the whole test set then recompose, stream: one image at a time, '
+                             'whole: one forward pass per image')
+    parser.add_argument('--tile_size', default=512, type=int,
+                        help='tile size of the whole image inference when a whole image does not fit in memory')
     parser.add_argument('--test_patch_height', default=96)
     parser.add_argument('--test_patch_width', default=96)
     parser.add_argument('--stride_height', default=16)
     parser.add_argument('--stride_width', default=16)
+    parser.add_argument('--prune_test_patches', default=True, type=bool,
+                        help='skip the test patches without any FOV pixel (patch and stream test modes, and serve.py requests with a FOV)')
+
+    # serving (serve.py)
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address the inference server listens on')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--max_batch_size', default=64, type=int,
+                        help='max number of patches, from all pending requests, per forward pass of the server')
+    parser.add_argument('--max_queue_delay', default=5, type=float,
+                        help='max time (ms) the server waits for more requests to fill a batch')
+    parser.add_argument('--threshold', default=0.5, type=float,
+                        help='probability threshold of the binary vessel maps')
+
+    # bulk segmentation (segment.py)
+    parser.add_argument('--input_images', default=None,
+                        help='directory (searched recursively) or glob pattern of the images to segment')
+    parser.add_argument('--output_dir', default=None,
+                        help='output directory of the segmentation maps, <outf>/<save>/segmentation by default')
+    parser.add_argument('--io_workers', default=4, type=int,
+                        help='number of threads decoding and writing the images')
+    parser.add_argument('--queue_size', default=16, type=int,
+                        help='max number of images waiting between two stages of the pipeline')
 
     # hardware setting
     parser.add_argument('--cuda', default=True, type=bool,
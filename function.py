@@ -5,41 +5,47 @@ from lib.losses.loss import *
 from lib.visualize import group_images, save_img
 from lib.common import *
 from lib.dataset import TrainDataset
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
 from collections import OrderedDict
 from lib.metrics import Evaluate
 from lib.visualize import group_images, save_img
 from lib.extract_patches import get_data_train
-from lib.datasetV2 import data_preprocess,create_patch_idx,TrainDatasetV2
+from lib.image_store import GroupedPatchSampler
+from lib.datasetV2 import data_preprocess,create_patch_idx,create_patch_sampler,TrainDatasetV2,TrainBatchDatasetV2,TrainStreamDatasetV2,to_shared_memory
 from tqdm import tqdm
 
 # ========================get dataloader==============================
 def get_dataloader(args):
     """
     该函数将数据集加载并直接提取所有训练样本图像块到内存，所以内存占用率较高，容易导致内存溢出
+    Set args.patch_store to write the patches into memory-mapped shards on disk instead.
     """
     patches_imgs_train, patches_masks_train = get_data_train(
         data_path_list = args.train_data_path_list,
         patch_height = args.train_patch_height,
         patch_width = args.train_patch_width,
         N_patches = args.N_patches,
-        inside_FOV = args.inside_FOV #select the patches only inside the FOV  (default == False)
+        inside_FOV = args.inside_FOV, #select the patches only inside the FOV  (default == False)
+        cache_dir = args.cache_dir,
+        patch_store = join(args.patch_store, args.save) if args.patch_store else None,
+        shard_size = args.patch_shard_size,
+        num_workers = args.preproc_workers
     )
-    val_ind = random.sample(range(patches_masks_train.shape[0]),int(np.floor(args.val_ratio*patches_masks_train.shape[0])))
-    train_ind =  set(range(patches_masks_train.shape[0])) - set(val_ind)
-    train_ind = list(train_ind)
+    # train and val sets only hold indices into the shared patch arrays
+    val_ind = np.sort(random.sample(range(patches_masks_train.shape[0]),int(np.floor(args.val_ratio*patches_masks_train.shape[0]))))
+    train_ind = np.setdiff1d(np.arange(patches_masks_train.shape[0]), val_ind)
 
-    train_set = TrainDataset(patches_imgs_train[train_ind,...],patches_masks_train[train_ind,...],mode="train")
+    train_set = TrainDataset(patches_imgs_train,patches_masks_train,mode="train",idx=train_ind,augment=not args.batch_aug)
     train_loader = DataLoader(train_set, batch_size=args.batch_size,
                               shuffle=True, num_workers=6)
 
-    val_set = TrainDataset(patches_imgs_train[val_ind,...],patches_masks_train[val_ind,...],mode="val")
+    val_set = TrainDataset(patches_imgs_train,patches_masks_train,mode="val",idx=val_ind)
     val_loader = DataLoader(val_set, batch_size=args.batch_size,
                             shuffle=False, num_workers=6)
     # Save some samples of feeding to the neural network
     if args.sample_visualization:
         N_sample = min(patches_imgs_train.shape[0], 50)
-        save_img(group_images((patches_imgs_train[0:N_sample, :, :, :]*255).astype(np.uint8), 10),
+        save_img(group_images(patches_imgs_train[0:N_sample, :, :, :], 10),
                 join(args.outf, args.save, "sample_input_imgs.png"))
         save_img(group_images((patches_masks_train[0:N_sample, :, :, :]*255).astype(np.uint8), 10),
                 join(args.outf, args.save,"sample_input_masks.png"))
@@ -50,47 +56,104 @@ def get_dataloaderV2(args):
     """
     该函数加载数据集所有图像到内存，并创建训练样本提取位置的索引，所以占用内存量较少，
     测试结果表明，相比于上述原始的get_dataloader方法并不会降低训练效率
+    With args.lazy_images, the images are loaded on demand into a bounded cache and the
+    patches are visited by groups of args.images_per_group images.
     """
-    imgs_train, masks_train, fovs_train = data_preprocess(data_path_list = args.train_data_path_list)
+    imgs_train, masks_train, fovs_train = data_preprocess(data_path_list = args.train_data_path_list, cache_dir = args.cache_dir,
+                                                          lazy_images = args.lazy_images, image_cache_mb = args.image_cache_mb,
+                                                          num_workers = args.preproc_workers)
 
-    patches_idx = create_patch_idx(fovs_train, args)
+    patches_idx = create_patch_idx(fovs_train, args, img_masks=masks_train)
 
     train_idx,val_idx = np.vsplit(patches_idx, (int(np.floor((1-args.val_ratio)*patches_idx.shape[0])),))
 
-    train_set = TrainDatasetV2(imgs_train, masks_train, fovs_train,train_idx,mode="train",args=args)
-    train_loader = DataLoader(train_set, batch_size=args.batch_size,
-                              shuffle=True, num_workers=0)
-
-    val_set = TrainDatasetV2(imgs_train, masks_train, fovs_train,val_idx,mode="val",args=args)
-    val_loader = DataLoader(val_set, batch_size=args.batch_size,
-                            shuffle=False, num_workers=0)
+    # shared by the train and val sets and by all the loader workers
+    imgs_train, masks_train, fovs_train = to_shared_memory(imgs_train), to_shared_memory(masks_train), to_shared_memory(fovs_train)
+    if args.lazy_images:
+        train_sampler = GroupedPatchSampler(train_idx, args.images_per_group, shuffle=True)
+        val_sampler = GroupedPatchSampler(val_idx, args.images_per_group, shuffle=False)
+    else:
+        train_sampler, val_sampler = RandomSampler(train_idx), SequentialSampler(val_idx)
+    if args.batch_gather:
+        # the datasets receive the indices of a whole batch and slice it in one call, no collate
+        train_set = TrainBatchDatasetV2(imgs_train, masks_train, fovs_train,train_idx,mode="train",args=args)
+        train_loader = DataLoader(train_set, sampler=BatchSampler(train_sampler, args.batch_size, drop_last=False),
+                                  batch_size=None, num_workers=args.num_workers, persistent_workers=args.num_workers>0)
+
+        val_set = TrainBatchDatasetV2(imgs_train, masks_train, fovs_train,val_idx,mode="val",args=args)
+        val_loader = DataLoader(val_set, sampler=BatchSampler(val_sampler, args.batch_size, drop_last=False),
+                                batch_size=None, num_workers=args.num_workers, persistent_workers=args.num_workers>0)
+    else:
+        train_set = TrainDatasetV2(imgs_train, masks_train, fovs_train,train_idx,mode="train",args=args)
+        train_loader = DataLoader(train_set, batch_size=args.batch_size,
+                                  sampler=train_sampler, num_workers=args.num_workers, persistent_workers=args.num_workers>0)
+
+        val_set = TrainDatasetV2(imgs_train, masks_train, fovs_train,val_idx,mode="val",args=args)
+        val_loader = DataLoader(val_set, batch_size=args.batch_size,
+                                sampler=val_sampler, num_workers=args.num_workers, persistent_workers=args.num_workers>0)
 
     # Save some samples of feeding to the neural network
     if args.sample_visualization:
         visual_set = TrainDatasetV2(imgs_train, masks_train, fovs_train,val_idx,mode="val",args=args)
         visual_loader = DataLoader(visual_set, batch_size=1,shuffle=True, num_workers=0)
         N_sample = 50
-        visual_imgs = np.empty((N_sample,1,args.train_patch_height, args.train_patch_width))
-        visual_masks = np.empty((N_sample,1,args.train_patch_height, args.train_patch_width))
+        visual_imgs = np.empty((N_sample,1,args.train_patch_height, args.train_patch_width), dtype=np.uint8)
+        visual_masks = np.empty((N_sample,1,args.train_patch_height, args.train_patch_width), dtype=np.uint8)
 
         for i, (img, mask) in tqdm(enumerate(visual_loader)):
             visual_imgs[i] = np.squeeze(img.numpy(),axis=0)
             visual_masks[i,0] = np.squeeze(mask.numpy(),axis=0)
             if i>=N_sample-1:
                 break
-        save_img(group_images((visual_imgs[0:N_sample, :, :, :]*255).astype(np.uint8), 10),
+        save_img(group_images(visual_imgs[0:N_sample, :, :, :], 10),
                 join(args.outf, args.save, "sample_input_imgs.png"))
         save_img(group_images((visual_masks[0:N_sample, :, :, :]*255).astype(np.uint8), 10),
                 join(args.outf, args.save,"sample_input_masks.png"))
     return train_loader,val_loader
 
+
+def get_dataloader_stream(args):
+    """
+    Like get_dataloaderV2, but no patch index is built for training: each epoch draws
+    args.stream_epoch_len fresh patch positions and crops them on the fly, so the model
+    sees new patches every epoch. The validation patches are drawn once and kept fixed.
+    """
+    imgs_train, masks_train, fovs_train = data_preprocess(data_path_list = args.train_data_path_list, cache_dir = args.cache_dir,
+                                                          num_workers = args.preproc_workers)
+
+    sampler = create_patch_sampler(fovs_train, args, img_masks=masks_train)
+    epoch_len = int(args.stream_epoch_len or int(args.N_patches)*(1-args.val_ratio))
+    val_idx = sampler.sample(int(np.ceil(epoch_len*args.val_ratio/(1-args.val_ratio))), np.random.default_rng(2021))
+
+    imgs_train, masks_train, fovs_train = to_shared_memory(imgs_train), to_shared_memory(masks_train), to_shared_memory(fovs_train)
+    train_set = TrainStreamDatasetV2(imgs_train, masks_train, sampler, epoch_len, args, chunk_size=args.stream_chunk_size)
+    train_loader = DataLoader(train_set, batch_size=None, num_workers=args.num_workers, persistent_workers=args.num_workers>0)
+
+    val_set = TrainBatchDatasetV2(imgs_train, masks_train, fovs_train,val_idx,mode="val",args=args)
+    val_loader = DataLoader(val_set, sampler=BatchSampler(SequentialSampler(val_set), args.batch_size, drop_last=False),
+                            batch_size=None, num_workers=args.num_workers, persistent_workers=args.num_workers>0)
+
+    # Save some samples of feeding to the neural network
+    N_sample = min(50, len(val_set)) // 10 * 10  # group_images() takes rows of 10
+    if args.sample_visualization and N_sample > 0:
+        visual_imgs, visual_masks = val_set[np.arange(N_sample)]
+        save_img(group_images(visual_imgs.numpy(), 10),
+                join(args.outf, args.save, "sample_input_imgs.png"))
+        save_img(group_images((visual_masks.numpy()[:,None]*255).astype(np.uint8), 10),
+                join(args.outf, args.save,"sample_input_masks.png"))
+    return train_loader,val_loader
+
 # =======================train======================== 
-def train(train_loader,net,criterion,optimizer,device):
+# batch_aug (optional): BatchAugment applied to each batch on the device, replacing the per-sample augmentation
+def train(train_loader,net,criterion,optimizer,device,batch_aug=None):
     net.train()
     train_loss = AverageMeter()
 
     for batch_idx, (inputs, targets) in tqdm(enumerate(train_loader), total=len(train_loader)):
         inputs, targets = inputs.to(device), targets.to(device)
+        if batch_aug is not None:
+            inputs, targets = batch_aug(inputs, targets)
+        inputs, targets = to_model_input(inputs), targets.long()
         optimizer.zero_grad()
 
         outputs = net(inputs)
@@ -109,7 +172,7 @@ def val(val_loader,net,criterion,device):
     evaluater = Evaluate()
     with torch.no_grad():
         for batch_idx, (inputs, targets) in tqdm(enumerate(val_loader), total=len(val_loader)):
-            inputs, targets = inputs.to(device), targets.to(device)
+            inputs, targets = to_model_input(inputs, device), targets.to(device).long()
             outputs = net(inputs)
             loss = criterion(outputs, targets)
             val_loss.update(loss.item(), inputs.size(0))
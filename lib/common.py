@@ -72,6 +72,14 @@ def setpu_seed(seed):
     torch.backends.cudnn.deterministic=True
     random.seed(seed)
 
+# Move a batch of imgs to the device, uint8 imgs are converted to float32 in [0,1] there
+def to_model_input(inputs, device=None):
+    if device is not None:
+        inputs = inputs.to(device, non_blocking=True)
+    if not inputs.is_floating_point():
+        inputs = inputs.float().div_(255)
+    return inputs
+
 # Round off
 def dict_round(dic,num):
     for key,value in dic.items():
@@ -0,0 +1,79 @@
+"""
+On-disk cache of preprocessed datasets.
+Each entry is a directory of .npy files named by a hash of the path list file, the
+mtimes/sizes (or content hashes, if the list has an up-to-date manifest) of the files it
+references and the preprocessing parameters, so it is invalidated automatically when any
+of them changes. Arrays are opened memory-mapped.
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from .data_manifest import load_manifest
+
+# Bump this when the layout or content of the cached arrays changes
+CACHE_VERSION = 1
+
+# Hash of the path list content, the state of every file it references and the given parameters
+def dataset_cache_key(data_path_list, **params):
+    h = hashlib.sha1()
+    with open(data_path_list, 'rb') as f:
+        content = f.read()
+    h.update(content)
+    manifest = load_manifest(data_path_list)
+    if manifest is not None:
+        for sample in manifest['samples']:
+            h.update(''.join(sample[name]['sha1'] for name in ('img', 'gt', 'fov')).encode())
+    else:
+        for path in content.decode().split():
+            st = os.stat(path)
+            h.update(('%s:%d:%d;' % (path, st.st_mtime_ns, st.st_size)).encode())
+    params = dict(params, cache_version=CACHE_VERSION)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+# Open the cached arrays memory-mapped, return None if the entry does not exist
+def load_cache(cache_dir, key, names):
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+    try:
+        return {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in names}
+    except (IOError, ValueError):
+        return None  # incomplete or corrupted entry, it will be rebuilt
+
+# Small JSON value (e.g. statistics of a data set) cached as <key>.json, None if there is none
+def load_cache_value(cache_dir, key):
+    try:
+        with open(os.path.join(cache_dir, key + '.json'), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def save_cache_value(cache_dir, key, value):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + key, dir=cache_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp_path, os.path.join(cache_dir, key + '.json'))
+
+# Write the arrays of a cache entry; the entry only becomes visible once it is complete
+def save_cache(cache_dir, key, arrays, meta=None):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+    tmp_entry = tempfile.mkdtemp(prefix='.' + key, dir=cache_dir)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp_entry, name + '.npy'), np.ascontiguousarray(arr))
+    with open(os.path.join(tmp_entry, 'meta.json'), 'w') as f:
+        json.dump(meta or {}, f, indent=2, default=str)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another process wrote the same entry in the meantime
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    return entry
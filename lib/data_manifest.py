@@ -0,0 +1,56 @@
+"""
+Manifest of a data path list, written by prepare_dataset/prepare.py next to the list
+(train.txt -> train.manifest.json). It records the size, mtime, content hash, shape and
+value range of every file, as checked when the list was prepared. While it is up to date,
+training uses it as the cache key of the data set and skips the range checks of load_data.
+"""
+import os
+import json
+import hashlib
+
+MANIFEST_VERSION = 1
+
+def manifest_path(data_path_list):
+    return os.path.splitext(data_path_list)[0] + '.manifest.json'
+
+def file_sha1(path, block_size=1024**2):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Record of one decoded file: state on disk, content hash, shape and value range
+def file_record(path, arr):
+    st = os.stat(path)
+    return {'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': file_sha1(path),
+            'shape': list(arr.shape), 'dtype': str(arr.dtype), 'min': int(arr.min()), 'max': int(arr.max())}
+
+def write_manifest(data_path_list, samples, meta=None):
+    with open(data_path_list, 'rb') as f:
+        list_sha1 = hashlib.sha1(f.read()).hexdigest()
+    manifest = dict(meta or {}, version=MANIFEST_VERSION, data_path_list=data_path_list,
+                    list_sha1=list_sha1, samples=samples)
+    with open(manifest_path(data_path_list), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest_path(data_path_list)
+
+# Manifest of the path list, None if there is none or if the list or any file changed since it was written
+def load_manifest(data_path_list):
+    path = manifest_path(data_path_list)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        with open(data_path_list, 'rb') as f:
+            if manifest['version'] != MANIFEST_VERSION or manifest['list_sha1'] != hashlib.sha1(f.read()).hexdigest():
+                return None
+        for sample in manifest['samples']:
+            for record in sample.values():
+                st = os.stat(record['path'])
+                if (st.st_size, st.st_mtime_ns) != (record['size'], record['mtime_ns']):
+                    return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return manifest
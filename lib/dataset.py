@@ -11,11 +11,16 @@ from torchvision import transforms
 from torchvision.transforms.functional import normalize
 
 class TrainDataset(Dataset):
-    def __init__(self, patches_imgs,patches_masks,mode="train"):
+    """
+    idx (optional) selects the patches of this set, so that the train and val sets
+    can share the same patch arrays (or memory-mapped patch store) without copying
+    """
+    def __init__(self, patches_imgs,patches_masks,mode="train",idx=None,augment=True):
         self.imgs = patches_imgs
         self.masks = patches_masks
+        self.idx = np.arange(patches_imgs.shape[0]) if idx is None else np.asarray(idx)
         self.transforms = None
-        if mode == "train":
+        if mode == "train" and augment:
             self.transforms = Compose([
                 # RandomResize([56,72],[56,72]),
                 RandomCrop((48, 48)),
@@ -25,20 +30,20 @@ class TrainDataset(Dataset):
             ])
 
     def __len__(self):
-        return self.imgs.shape[0]
+        return len(self.idx)
 
     def __getitem__(self, idx):
-        mask = self.masks[idx]
-        data = self.imgs[idx]
-
-        data = torch.from_numpy(data).float()
-        mask = torch.from_numpy(mask).long()
+        idx = self.idx[idx]
+        # uint8 patches, converted to float/long per batch in train()/val()
+        data = torch.from_numpy(np.array(self.imgs[idx]))
+        mask = torch.from_numpy(np.array(self.masks[idx]))
 
         if self.transforms:
             data, mask = self.transforms(data, mask)
         return data, mask.squeeze(0)
 
 #----------------------data augment-------------------------------------------
+# The random transforms draw from rng, the global `random` module unless a random.Random is given
 class Resize:
     def __init__(self, shape):
         self.shape = [shape, shape] if isinstance(shape, int) else shape
@@ -50,13 +55,14 @@ class Resize:
         return img[0], mask[0].byte()
 
 class RandomResize:
-    def __init__(self, w_rank,h_rank):
+    def __init__(self, w_rank,h_rank, rng=random):
         self.w_rank = w_rank
         self.h_rank = h_rank
+        self.rng = rng
 
     def __call__(self, img, mask):
-        random_w = random.randint(self.w_rank[0],self.w_rank[1])
-        random_h = random.randint(self.h_rank[0],self.h_rank[1])
+        random_w = self.rng.randint(self.w_rank[0],self.w_rank[1])
+        random_h = self.rng.randint(self.h_rank[0],self.h_rank[1])
         self.shape = [random_w,random_h]
         img, mask = img.unsqueeze(0), mask.unsqueeze(0).float()
         img = F.interpolate(img, size=self.shape, mode="bilinear", align_corners=False)
@@ -64,16 +70,17 @@ class RandomResize:
         return img[0], mask[0].long()
 
 class RandomCrop:
-    def __init__(self, shape):
+    def __init__(self, shape, rng=random):
         self.shape = [shape, shape] if isinstance(shape, int) else shape
         self.fill = 0
         self.padding_mode = 'constant'
+        self.rng = rng
 
     def _get_range(self, shape, crop_shape):
         if shape == crop_shape:
             start = 0
         else:
-            start = random.randint(0, shape - crop_shape)
+            start = self.rng.randint(0, shape - crop_shape)
         end = start + crop_shape
         return start, end
 
@@ -84,8 +91,9 @@ class RandomCrop:
         return img[:, sh:eh, sw:ew], mask[:, sh:eh, sw:ew]
 
 class RandomFlip_LR:
-    def __init__(self, prob=0.5):
+    def __init__(self, prob=0.5, rng=random):
         self.prob = prob
+        self.rng = rng
 
     def _flip(self, img, prob):
         if prob[0] <= self.prob:
@@ -93,12 +101,13 @@ class RandomFlip_LR:
         return img
 
     def __call__(self, img, mask):
-        prob = (random.uniform(0, 1), random.uniform(0, 1))
+        prob = (self.rng.uniform(0, 1), self.rng.uniform(0, 1))
         return self._flip(img, prob), self._flip(mask, prob)
 
 class RandomFlip_UD:
-    def __init__(self, prob=0.5):
+    def __init__(self, prob=0.5, rng=random):
         self.prob = prob
+        self.rng = rng
 
     def _flip(self, img, prob):
         if prob[1] <= self.prob:
@@ -106,19 +115,20 @@ class RandomFlip_UD:
         return img
 
     def __call__(self, img, mask):
-        prob = (random.uniform(0, 1), random.uniform(0, 1))
+        prob = (self.rng.uniform(0, 1), self.rng.uniform(0, 1))
         return self._flip(img, prob), self._flip(mask, prob)
 
 class RandomRotate:
-    def __init__(self, max_cnt=3):
+    def __init__(self, max_cnt=3, rng=random):
         self.max_cnt = max_cnt
+        self.rng = rng
 
     def _rotate(self, img, cnt):
         img = torch.rot90(img,cnt,[1,2])
         return img
 
     def __call__(self, img, mask):
-        cnt = random.randint(0,self.max_cnt)
+        cnt = self.rng.randint(0,self.max_cnt)
         return self._rotate(img, cnt), self._rotate(mask, cnt)
 
 
@@ -141,6 +151,50 @@ class Normalize:
         return normalize(img, self.mean, self.std, False), mask
 
 
+class BatchAugment:
+    """
+    Batch version of RandomCrop, RandomFlip_LR, RandomFlip_UD and RandomRotate,
+    applied to a collated batch of imgs (B,C,H,W) and masks (B,H,W) or (B,1,H,W).
+    The random parameters of all samples are drawn at once from generator, the crops
+    and flips are done by one gather and the rotations by one rot90 per angle.
+    """
+    def __init__(self, crop_shape=(48, 48), flip_prob=0.5, max_rot=3, generator=None):
+        self.crop_shape = [crop_shape, crop_shape] if isinstance(crop_shape, int) else crop_shape
+        self.flip_prob = flip_prob
+        self.max_rot = max_rot
+        self.generator = generator
+        assert max_rot == 0 or self.crop_shape[0] == self.crop_shape[1], "rotation needs a square crop"
+
+    def _params(self, B, H, W):
+        g = self.generator
+        ch, cw = self.crop_shape
+        rows = torch.randint(0, H-ch+1, (B,1), generator=g) + torch.arange(ch)
+        cols = torch.randint(0, W-cw+1, (B,1), generator=g) + torch.arange(cw)
+        flip_lr = torch.rand(B, generator=g) <= self.flip_prob
+        flip_ud = torch.rand(B, generator=g) <= self.flip_prob
+        cols = torch.where(flip_lr[:,None], cols.flip(1), cols)
+        rows = torch.where(flip_ud[:,None], rows.flip(1), rows)
+        rot = torch.randint(0, self.max_rot+1, (B,), generator=g)
+        return rows, cols, rot
+
+    def __call__(self, imgs, masks):
+        B, _, H, W = imgs.shape
+        rows, cols, rot = [t.to(imgs.device) for t in self._params(B, H, W)]
+        b = torch.arange(B, device=imgs.device)[:,None,None]
+        # crop + flips: advanced indices around the channel slice give (B,h,w,C)
+        imgs = imgs[b, :, rows[:,:,None], cols[:,None,:]].permute(0,3,1,2).contiguous()
+        if masks.dim() == 4:
+            masks = masks[b, :, rows[:,:,None], cols[:,None,:]].permute(0,3,1,2).contiguous()
+        else:
+            masks = masks[b, rows[:,:,None], cols[:,None,:]]
+        for k in range(1, self.max_rot+1):
+            sel = rot == k
+            if sel.any():
+                imgs[sel] = torch.rot90(imgs[sel], k, [-2,-1])
+                masks[sel] = torch.rot90(masks[sel], k, [-2,-1])
+        return imgs, masks
+
+
 class Compose:
     def __init__(self, transforms):
         self.transforms = transforms
@@ -161,7 +215,7 @@ class TestDataset(Dataset):
         return self.imgs.shape[0]
 
     def __getitem__(self, idx):
-        return torch.from_numpy(self.imgs[idx,...]).float()
+        return torch.from_numpy(np.array(self.imgs[idx,...]))
 
 #----------------------image aug--------------------------------------
 class TrainDataset_imgaug(Dataset):
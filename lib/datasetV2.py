@@ -1,84 +1,209 @@
 """
 This dataset is used reduce memory usage during training
 """
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import torch
 import numpy as np
 import random
+import multiprocessing as mp
 import torch.nn.functional as F
 from torchvision import transforms
 from torchvision.transforms.functional import normalize
 
-from .extract_patches import load_data, my_PreProc, is_patch_inside_FOV
-from .dataset import RandomCrop, RandomFlip_LR, RandomFlip_UD, RandomRotate, Compose
+from .extract_patches import load_preprocessed_data
+from .h5_dataset import is_hdf5
+from .image_store import LazyImageStore
+from .patch_sampler import PatchCenterSampler, STRATA, gather_patches
+from .dataset import RandomCrop, RandomFlip_LR, RandomFlip_UD, RandomRotate, Compose, BatchAugment
 
 class TrainDatasetV2(Dataset):
-    def __init__(self, imgs,masks,fovs,patches_idx,mode,args):
+    """
+    imgs, masks and fovs can be numpy arrays, lazily read arrays (HDF5, LazyImageStore) or tensors
+    in shared memory (see to_shared_memory), which DataLoader workers use without copying.
+    The augmentations draw from a random.Random of the dataset, which is reseeded in every worker
+    (and in the main process) from (seed, epoch, worker id) when the epoch set by set_epoch changes,
+    so the global `random` module of the trainer is left alone.
+    """
+    def __init__(self, imgs,masks,fovs,patches_idx,mode,args,seed=2021):
         self.imgs = imgs
 
         self.masks = masks
         self.fovs = fovs
-        self.patch_h, self.patch_w = args.train_patch_height, args.train_patch_width
+        self.patch_h, self.patch_w = int(args.train_patch_height), int(args.train_patch_width)
         self.patches_idx = patches_idx
         self.inside_FOV = args.inside_FOV
+        self.seed = seed
+        self.epoch = mp.RawValue('i', 0)  # shared with the workers, so persistent workers see set_epoch
+        self._rng_key = None
+        self.rng = random.Random(seed)
         self.transforms = None
-        if mode == "train":
+        if mode == "train" and not args.batch_aug:  # otherwise augmented per batch by BatchAugment
             self.transforms = Compose([
                 # RandomResize([56,72],[56,72]),
-                RandomCrop((48, 48)),
-                RandomFlip_LR(prob=0.5),
-                RandomFlip_UD(prob=0.5),
-                RandomRotate()
+                RandomCrop((48, 48), rng=self.rng),
+                RandomFlip_LR(prob=0.5, rng=self.rng),
+                RandomFlip_UD(prob=0.5, rng=self.rng),
+                RandomRotate(rng=self.rng)
             ])
 
     def __len__(self):
         return len(self.patches_idx)
 
+    # Call before iterating the DataLoader of each epoch
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    # Seed of the augmentation of this worker and epoch, None if it has not changed since the last call
+    def _seed_rng(self):
+        worker_info = get_worker_info()
+        # a worker forked after the main process used the dataset must not take its key for its own
+        key = (self.epoch.value, worker_info.id if worker_info is not None else 0, worker_info is not None)
+        if key == self._rng_key:
+            return None
+        self._rng_key = key
+        seed = int(np.random.SeedSequence([self.seed, key[0], key[1]]).generate_state(1)[0])
+        self.rng.seed(seed)
+        return seed
+
     def __getitem__(self, idx):
         n, x_center, y_center = self.patches_idx[idx]
 
         data = self.imgs[n,:,y_center-int(self.patch_h/2):y_center+int(self.patch_h/2),x_center-int(self.patch_w/2):x_center+int(self.patch_w/2)]
         mask = self.masks[n,:,y_center-int(self.patch_h/2):y_center+int(self.patch_h/2),x_center-int(self.patch_w/2):x_center+int(self.patch_w/2)]
 
-        data = torch.from_numpy(data).float()
-        mask = torch.from_numpy(mask).long()
+        # uint8 patches, converted to float/long per batch in train()/val()
+        data = data if torch.is_tensor(data) else torch.from_numpy(np.array(data))
+        mask = mask if torch.is_tensor(mask) else torch.from_numpy(np.array(mask))
 
         if self.transforms:
+            self._seed_rng()
             data, mask = self.transforms(data, mask)
         return data, mask.squeeze(0)
 
 
-#----------------------Related Methon--------------------------------------
-def data_preprocess(data_path_list):
-    train_imgs_original, train_masks, train_FOVs = load_data(data_path_list)
-    # save_img(group_images(train_imgs_original[0:20,:,:,:],5),'imgs_train.png')#.show()  #check original train imgs 
+class TrainBatchDatasetV2(TrainDatasetV2):
+    """
+    __getitem__ receives the index array of a whole batch (from a BatchSampler, with
+    DataLoader(batch_size=None)) and slices all its patches with one vectorized gather,
+    returning contiguous (B,C,h,w) imgs and (B,h,w) masks.
+    In train mode without args.batch_aug the batch is augmented here by BatchAugment.
+    """
+    def __init__(self, imgs,masks,fovs,patches_idx,mode,args,seed=2021):
+        super().__init__(imgs,masks,fovs,patches_idx,mode,args,seed)
+        self.batch_transforms = None
+        if self.transforms is not None:
+            self.transforms = None
+            self.batch_transforms = BatchAugment(crop_shape=(48, 48), generator=torch.Generator())
+
+    def __getitem__(self, idx):
+        centers = self.patches_idx[np.asarray(idx)]
+        data = torch.from_numpy(gather_batch(self.imgs, centers, self.patch_h, self.patch_w))
+        mask = torch.from_numpy(gather_batch(self.masks, centers, self.patch_h, self.patch_w))[:,0]
+        if self.batch_transforms is not None:
+            seed = self._seed_rng()
+            if seed is not None:
+                self.batch_transforms.generator.manual_seed(seed)
+            data, mask = self.batch_transforms(data, mask)
+        return data, mask
+
+
+class TrainStreamDatasetV2(IterableDataset):
+    """
+    Streaming training set: every epoch draws epoch_len fresh patch centers from sampler
+    (a PatchCenterSampler) and crops them on the fly from the full imgs, chunk_size centers
+    at a time, so memory does not grow with the number of patches and no index is built.
+    Yields (B,C,h,w) imgs and (B,h,w) masks batches, use with DataLoader(batch_size=None).
+    The batches are split between the loader workers, each drawing from its own
+    generator seeded by (seed, epoch, worker id).
+    """
+    def __init__(self, imgs,masks,sampler,epoch_len,args,chunk_size=8192,seed=2021):
+        self.imgs = imgs
+        self.masks = masks
+        self.sampler = sampler
+        self.epoch_len = int(epoch_len)
+        self.batch_size = args.batch_size
+        self.chunk_size = max(chunk_size//self.batch_size, 1) * self.batch_size
+        self.patch_h, self.patch_w = int(args.train_patch_height), int(args.train_patch_width)
+        self.seed = seed
+        self.epoch = mp.RawValue('i', 0)
+        self.batch_transforms = None
+        if not args.batch_aug:
+            self.batch_transforms = BatchAugment(crop_shape=(48, 48), generator=torch.Generator())
+
+    def __len__(self):
+        return (self.epoch_len + self.batch_size - 1) // self.batch_size
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        seed = np.random.SeedSequence([self.seed, self.epoch.value, worker_id])
+        rng = np.random.default_rng(seed)
+        if self.batch_transforms is not None:
+            self.batch_transforms.generator.manual_seed(int(seed.generate_state(1)[0]))
+        # sizes of the batches of this worker
+        sizes = [min(self.batch_size, self.epoch_len-i*self.batch_size) for i in range(worker_id, len(self), num_workers)]
+        per_chunk = self.chunk_size // self.batch_size
+        for start in range(0, len(sizes), per_chunk):
+            chunk = sizes[start:start+per_chunk]
+            centers = self.sampler.sample(sum(chunk), rng)
+            offset = 0
+            for size in chunk:
+                batch = centers[offset:offset+size]
+                offset += size
+                data = torch.from_numpy(gather_batch(self.imgs, batch, self.patch_h, self.patch_w))
+                mask = torch.from_numpy(gather_batch(self.masks, batch, self.patch_h, self.patch_w))[:,0]
+                if self.batch_transforms is not None:
+                    data, mask = self.batch_transforms(data, mask)
+                yield data, mask
 
-    train_imgs = my_PreProc(train_imgs_original)
-    train_masks = train_masks//255
-    train_FOVs = train_FOVs//255
+
+#----------------------Related Methon--------------------------------------
+# Slice the patches at centers [n, x_center, y_center] into one contiguous (B,C,h,w) array
+def gather_batch(arr, centers, patch_h, patch_w):
+    if torch.is_tensor(arr):
+        arr = arr.numpy()
+    if isinstance(arr, np.ndarray):
+        return np.ascontiguousarray(gather_patches(arr, centers, patch_h, patch_w))
+    # lazily read arrays are sliced patch by patch
+    return np.stack([arr[n,:,y-int(patch_h/2):y+int(patch_h/2),x-int(patch_w/2):x+int(patch_w/2)]
+                     for n, x, y in centers])
+
+# Copy an in-memory array into a shared memory tensor, so that DataLoader workers do not duplicate it.
+# Lazily read arrays (HDF5) are returned as they are, every worker opens its own file handle
+def to_shared_memory(arr):
+    if not isinstance(arr, np.ndarray):
+        return arr
+    shared = torch.from_numpy(np.empty(arr.shape, dtype=arr.dtype)).share_memory_()
+    shared.numpy()[...] = arr
+    return shared
+
+# For an HDF5 data set, imgs and masks stay on disk and only the chunks covered by a patch are read.
+# With lazy_images, the images of a path list are loaded and preprocessed on demand
+# and at most image_cache_mb MB of them are kept in memory (see LazyImageStore)
+def data_preprocess(data_path_list, cache_dir=None, lazy_images=False, image_cache_mb=1024, num_workers=None):
+    if lazy_images and not is_hdf5(data_path_list):
+        store = LazyImageStore(data_path_list, cache_mb=image_cache_mb)
+        return store.imgs, store.masks, store.fovs
+    train_imgs, train_masks, train_FOVs = load_preprocessed_data(data_path_list, cache_dir, lazy=True, num_workers=num_workers)
     return train_imgs, train_masks, train_FOVs
 
-def create_patch_idx(img_fovs, args):
+# Patch center sampler of the training set: uniform among the valid positions of all images,
+# or with args.sampling=='stratified', with args.strata_ratio of vessel-rich, mixed and background patches
+def create_patch_sampler(img_fovs, args, img_masks=None):
     assert len(img_fovs.shape)==4
-    N,C,img_h,img_w = img_fovs.shape
-    res = np.empty((args.N_patches,3),dtype=int)
-    print("")
-
-    seed=2021
-    count = 0
-    while count < args.N_patches:
-        random.seed(seed) # fuxian
-        seed+=1
-        n = random.randint(0,N-1)
-        x_center = random.randint(0+int(args.train_patch_width/2),img_w-int(args.train_patch_width/2))
-        y_center = random.randint(0+int(args.train_patch_height/2),img_h-int(args.train_patch_height/2))
-
-        #check whether the patch is contained in the FOV
-        if args.inside_FOV=='center' or args.inside_FOV == 'all':
-            if not is_patch_inside_FOV(x_center,y_center,img_fovs[n,0],args.train_patch_height,args.train_patch_width,mode=args.inside_FOV):
-                continue
-        res[count] = np.asarray([n,x_center,y_center])
-        count+=1
-
-    return res
+    if args.sampling == 'stratified':
+        assert img_masks is not None, "stratified sampling needs the GTs"
+        sampler = PatchCenterSampler(img_fovs, args.train_patch_height, args.train_patch_width, args.inside_FOV,
+                                     masks=img_masks, density_thresholds=args.density_thresholds, strata_ratio=args.strata_ratio)
+        print("valid patch centers of strata {}: {}".format(STRATA, sampler.counts.sum(axis=0)))
+        return sampler
+    return PatchCenterSampler(img_fovs, args.train_patch_height, args.train_patch_width, args.inside_FOV)
+
+# Draw args.N_patches patch centers [n, x_center, y_center]
+def create_patch_idx(img_fovs, args, seed=2021, img_masks=None):
+    sampler = create_patch_sampler(img_fovs, args, img_masks)
+    return sampler.sample(int(args.N_patches), np.random.default_rng(seed)) # fuxian
 
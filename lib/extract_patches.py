@@ -4,12 +4,19 @@ The image patches are randomly extracted in the fov(optional) during the trainin
 and the test phase needs to be spliced after splitting
 """
 import numpy as np
-import random
 import configparser
+import json
+from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
 
 from .visualize import save_img, group_images
 from .common import readImg
-from .pre_processing import my_PreProc
+from .pre_processing import my_PreProc, PREPROC_PARAMS, rgb2gray, image_moments, combine_moments
+from .data_cache import dataset_cache_key, load_cache, save_cache, load_cache_value, save_cache_value
+from .data_manifest import load_manifest, manifest_path
+from .h5_dataset import is_hdf5, load_hdf5, read_hdf5_attr, hdf5_names
+from .patch_store import create_patch_store
+from .patch_sampler import PatchCenterSampler, gather_patches
 
 #=================Load imgs from disk with txt files=====================================
 # Load data path index file
@@ -28,52 +35,173 @@ def load_file_path_txt(file_path):
             fov_list.append(fov)
     return img_list,gt_list,fov_list
 
-# Load the original image, grroundtruth and FOV of the data set in order, and check the dimensions
-def load_data(data_path_list_file):
+# Names of the images of a data set (path list or HDF5 file), used to save the results
+def load_img_names(data_path_list):
+    if is_hdf5(data_path_list):
+        img_list = read_hdf5_attr(data_path_list, 'img_paths')
+    else:
+        img_list, _, _ = load_file_path_txt(data_path_list)
+    return [item.split('/')[-1].split('.')[0] for item in img_list]
+
+# Decode one image file as a 2D (H,W) or 3D (H,W,C) array, single-channel files keep the first channel only
+def read_array(path, single_channel=False):
+    arr = np.asarray(readImg(path))
+    if single_channel and len(arr.shape)==3:
+        arr = arr[:,:,0]
+    if arr.dtype == bool:
+        arr = arr.astype(np.uint8)
+    return arr
+
+# Load the original image, grroundtruth and FOV of the data set in order, and check the dimensions.
+# The shapes are probed on the first sample, the output arrays are preallocated
+# and the remaining files are decoded by a thread pool directly into their slots.
+# The value range checks are skipped if the files were checked by prepare_dataset/prepare.py
+# and have not changed since (see lib/data_manifest.py)
+def load_data(data_path_list_file, num_workers=None):
     print('\033[0;33mload data from {} \033[0m'.format(data_path_list_file))
     img_list, gt_list, fov_list = load_file_path_txt(data_path_list_file)
-    imgs = None
-    groundTruth = None
-    FOVs = None
-    for i in range(len(img_list)):
-        img = np.asarray(readImg(img_list[i]))
-        gt = np.asarray(readImg(gt_list[i]))
-        if len(gt.shape)==3:
-            gt = gt[:,:,0]
-        fov = np.asarray(readImg(fov_list[i]))
-        if len(fov.shape)==3:
-            fov = fov[:,:,0]
-
-        imgs = np.expand_dims(img,0) if imgs is None else np.concatenate((imgs,np.expand_dims(img,0)))
-        groundTruth = np.expand_dims(gt,0) if groundTruth is None else np.concatenate((groundTruth,np.expand_dims(gt,0)))
-        FOVs = np.expand_dims(fov,0) if FOVs is None else np.concatenate((FOVs,np.expand_dims(fov,0)))
-    
-    assert(np.min(FOVs)==0 and np.max(FOVs)==255)
-    assert((np.min(groundTruth)==0 and (np.max(groundTruth)==255 or np.max(groundTruth)==1))) # CHASE_DB1数据集GT图像为单通道二值（0和1）图像
-    if np.max(groundTruth)==1:
+    img = read_array(img_list[0])
+    gt = read_array(gt_list[0], single_channel=True)
+    fov = read_array(fov_list[0], single_channel=True)
+    N = len(img_list)
+    #imgs are stored as [N,C,H,W]
+    imgs = np.empty((N,img.shape[2])+img.shape[:2], dtype=img.dtype)
+    groundTruth = np.empty((N,)+gt.shape, dtype=gt.dtype)
+    FOVs = np.empty((N,)+fov.shape, dtype=fov.dtype)
+    imgs[0], groundTruth[0], FOVs[0] = np.transpose(img,(2,0,1)), gt, fov
+
+    def load_into(out, i, path, single_channel):
+        arr = read_array(path, single_channel)
+        if not single_channel:
+            arr = np.transpose(arr,(2,0,1))
+        if arr.shape != out.shape[1:]:
+            raise ValueError("Shape {} of {} is different from shape {} of the first sample".format(arr.shape, path, out.shape[1:]))
+        out[i] = arr
+
+    jobs = [(imgs, i, img_list[i], False) for i in range(1,N)] + \
+           [(groundTruth, i, gt_list[i], True) for i in range(1,N)] + \
+           [(FOVs, i, fov_list[i], True) for i in range(1,N)]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # list() re-raises the first failed decoding
+        list(executor.map(lambda job: load_into(*job), jobs))
+
+    manifest = load_manifest(data_path_list_file)
+    if manifest is None:
+        assert(np.min(FOVs)==0 and np.max(FOVs)==255)
+        assert((np.min(groundTruth)==0 and (np.max(groundTruth)==255 or np.max(groundTruth)==1))) # CHASE_DB1数据集GT图像为单通道二值（0和1）图像
+        gt_max = np.max(groundTruth)
+    else:
+        gt_max = max(sample['gt']['max'] for sample in manifest['samples'])
+    if gt_max==1:
         print("\033[0;31m Single channel binary image is multiplied by 255 \033[0m")
         groundTruth = groundTruth * 255
 
-    #Convert the dimension of imgs to [N,C,H,W]
-    imgs = np.transpose(imgs,(0,3,1,2))
+    #Convert the dimension of GTs and FOVs to [N,1,H,W]
     groundTruth = np.expand_dims(groundTruth,1)
     FOVs = np.expand_dims(FOVs,1)
     print('ori data shape < ori_imgs:{} GTs:{} FOVs:{}'.format(imgs.shape,groundTruth.shape,FOVs.shape))
-    print("imgs pixel range %s-%s: " %(str(np.min(imgs)),str(np.max(imgs))))
-    print("GTs pixel range %s-%s: " %(str(np.min(groundTruth)),str(np.max(groundTruth))))
-    print("FOVs pixel range %s-%s: " %(str(np.min(FOVs)),str(np.max(FOVs))))
+    if manifest is None:
+        print("imgs pixel range %s-%s: " %(str(np.min(imgs)),str(np.max(imgs))))
+        print("GTs pixel range %s-%s: " %(str(np.min(groundTruth)),str(np.max(groundTruth))))
+        print("FOVs pixel range %s-%s: " %(str(np.min(FOVs)),str(np.max(FOVs))))
+    else:
+        print("value ranges checked by the manifest {}".format(manifest_path(data_path_list_file)))
     print("==================data have loaded======================")
     return imgs, groundTruth, FOVs
 
+# Normalization moments of the data path lists preprocessed in this process (see load_preprocessed_data)
+_norm_moments = {}
+
+# Cache key of the normalization moments of the imgs of a data path list
+def norm_moments_key(data_path_list):
+    return dataset_cache_key(data_path_list, stats='norm_moments')
+
+# Pixel moments (count, mean, M2) of the gray versions of N original imgs, read(i) giving img i as [1,3,H,W]
+def dataset_moments(read, N, num_workers=None):
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        n, mean, m2 = reduce(combine_moments, executor.map(lambda i: image_moments(rgb2gray(read(i))), range(N)))
+    return int(n), float(mean), float(m2)
+
+# Pixel moments (count, mean, M2) of the gray imgs of a data set (save them with pre_processing.save_norm_stats).
+# They are kept by load_preprocessed_data when it preprocesses the data set, or taken from the cache
+# (stored there with the preprocessed data set) or from the attributes of a HDF5 file;
+# only otherwise are the imgs decoded again to compute them image by image.
+# Returns None, with a warning, for a HDF5 file packed without them nor the original imgs
+def compute_norm_stats(data_path_list, num_workers=None, cache_dir=None):
+    moments = None
+    if is_hdf5(data_path_list):
+        moments = read_hdf5_attr(data_path_list, 'norm_moments')
+        if moments is None:
+            if 'ori_imgs' not in hdf5_names(data_path_list):
+                print("\033[0;31m{} has neither normalization statistics nor original imgs, "
+                      "the test set will be normalized with its own statistics\033[0m".format(data_path_list))
+                return None
+            ori_imgs = load_hdf5(data_path_list, ['ori_imgs'], lazy_names=('ori_imgs',))['ori_imgs']
+            moments = dataset_moments(lambda i: ori_imgs[i:i+1], len(ori_imgs), num_workers)
+    else:
+        moments = _norm_moments.get(data_path_list)
+        if moments is None and cache_dir:
+            moments = load_cache_value(cache_dir, norm_moments_key(data_path_list))
+        if moments is None:
+            img_list, _, _ = load_file_path_txt(data_path_list)
+            moments = dataset_moments(lambda i: np.transpose(read_array(img_list[i]),(2,0,1))[None], len(img_list), num_workers)
+            if cache_dir:
+                save_cache_value(cache_dir, norm_moments_key(data_path_list), moments)
+    n, mean, m2 = moments
+    print('normalization statistics of {}: mean {:.4f} std {:.4f}'.format(data_path_list, mean, np.sqrt(m2/n)))
+    return int(n), float(mean), float(m2)
+
+# Load the preprocessed imgs and the binary (0/1) GTs and FOVs of the data set.
+# If cache_dir is set, the result is stored there and memory-mapped on later calls.
+# data_path_list can also be an HDF5 file packed by prepare_dataset/pack_hdf5.py,
+# with lazy=True its imgs and GTs are then read chunk by chunk on access. If it was packed
+# without the original imgs (--no_original), None is returned for them.
+# num_workers is the number of threads decoding and preprocessing the images.
+# norm_stats: frozen (mean, std) of the normalization, computed from the data set itself if None
+def load_preprocessed_data(data_path_list, cache_dir=None, keep_original=False, lazy=False, num_workers=None, norm_stats=None):
+    names = ['imgs', 'masks', 'fovs'] + (['ori_imgs'] if keep_original else [])
+    if is_hdf5(data_path_list):
+        print('\033[0;33mload preprocessed data from {} \033[0m'.format(data_path_list))
+        if read_hdf5_attr(data_path_list, 'preproc') != json.loads(json.dumps(PREPROC_PARAMS)):
+            print("\033[0;31m{} was packed with different preprocessing parameters\033[0m".format(data_path_list))
+        if norm_stats is not None:
+            print("\033[0;31m{} was preprocessed with its own normalization statistics\033[0m".format(data_path_list))
+        stored = hdf5_names(data_path_list)
+        if keep_original and 'ori_imgs' not in stored:
+            print("\033[0;31m{} has no original imgs (packed with --no_original), the results cannot be visualized\033[0m".format(data_path_list))
+        arrays = load_hdf5(data_path_list, [name for name in names if name in stored or name != 'ori_imgs'],
+                           lazy_names=('imgs', 'masks') if lazy else ())
+        return tuple(arrays.get(name) for name in names)
+    if cache_dir:
+        params = dict(PREPROC_PARAMS, **({'norm_stats': norm_stats} if norm_stats is not None else {}))
+        key = dataset_cache_key(data_path_list, keep_original=keep_original, **params)
+        cached = load_cache(cache_dir, key, names)
+        if cached is not None:
+            print('\033[0;33mload preprocessed data of {} from cache {} \033[0m'.format(data_path_list, key))
+            return tuple(cached[name] for name in names)
+
+    imgs_original, masks, FOVs = load_data(data_path_list, num_workers)
+    # save_img(group_images(imgs_original[0:20,:,:,:],5),'imgs_train.png')#.show()  #check original train imgs
+    if norm_stats is None:
+        # the dataset statistics of the preprocessing are the normalization statistics of the data set
+        imgs, _norm_moments[data_path_list] = my_PreProc(imgs_original, num_workers, return_moments=True)
+    else:
+        imgs = my_PreProc(imgs_original, num_workers, norm_stats)
+    masks = masks//255
+    FOVs = FOVs//255
+    arrays = dict(zip(names, (imgs, masks, FOVs, imgs_original)))
+    if cache_dir:
+        if norm_stats is None:
+            save_cache_value(cache_dir, norm_moments_key(data_path_list), _norm_moments[data_path_list])
+        entry = save_cache(cache_dir, key, arrays, meta={'data_path_list': data_path_list, 'preproc': PREPROC_PARAMS})
+        print('preprocessed data cached in {}'.format(entry))
+    return tuple(arrays[name] for name in names)
+
 #==============================Load train data==============================================
 #Load the original data and return the extracted patches for training
-def get_data_train(data_path_list,patch_height,patch_width,N_patches,inside_FOV):
-    train_imgs_original, train_masks, train_FOVs = load_data(data_path_list)
-    # save_img(group_images(train_imgs_original[0:20,:,:,:],5),'imgs_train.png')#.show()  #check original train imgs 
-
-    train_imgs = my_PreProc(train_imgs_original)
-    train_masks = train_masks/255.
-    train_FOVs = train_FOVs//255
+# If patch_store is set, the patches are written into memory-mapped shards in that directory
+def get_data_train(data_path_list,patch_height,patch_width,N_patches,inside_FOV,cache_dir=None,patch_store=None,shard_size=10000,num_workers=None):
+    train_imgs, train_masks, train_FOVs = load_preprocessed_data(data_path_list, cache_dir, num_workers=num_workers)
     
     # Crop edge (optional)
     # train_imgs = train_imgs[:,:,9:-9,9:-9]   
@@ -89,42 +217,43 @@ def get_data_train(data_path_list,patch_height,patch_width,N_patches,inside_FOV)
         .format(train_imgs.shape, str(np.min(train_imgs)), str(np.max(train_imgs))))
 
     #extract the train patches from all images
-    patches_imgs_train, patches_masks_train = extract_random(train_imgs,train_masks,train_FOVs,patch_height,patch_width,N_patches,inside_FOV)
+    patches_imgs_train, patches_masks_train = extract_random(train_imgs,train_masks,train_FOVs,patch_height,patch_width,N_patches,inside_FOV,
+                                                             patch_store=patch_store,shard_size=shard_size)
     data_dim_check(patches_imgs_train, patches_masks_train)
 
-    print("train patches shape: {}, value range ({} - {})"\
-        .format(patches_imgs_train.shape, str(np.min(patches_imgs_train)), str(np.max(patches_imgs_train))))
+    if patch_store is None:
+        print("train patches shape: {}, value range ({} - {})"\
+            .format(patches_imgs_train.shape, str(np.min(patches_imgs_train)), str(np.max(patches_imgs_train))))
+    else:
+        print("train patches shape: {}, stored in {}".format(patches_imgs_train.shape, patch_store))
 
     return patches_imgs_train, patches_masks_train
 
 # extract patches randomly in the training images
-def extract_random(full_imgs,full_masks,full_FOVs, patch_h,patch_w, N_patches, inside='not'):
+# The centers are drawn at once by PatchCenterSampler; without a seed, it is derived from the global numpy RNG
+def extract_random(full_imgs,full_masks,full_FOVs, patch_h,patch_w, N_patches, inside='not', patch_store=None, shard_size=10000, seed=None):
     patch_per_img = int(N_patches/full_imgs.shape[0])
     if (N_patches%full_imgs.shape[0] != 0):
         print("\033[0;31mRecommended N_patches be set as a multiple of train img numbers\033[0m")
         N_patches = patch_per_img * full_imgs.shape[0]
     print("patches per image: " +str(patch_per_img), "  Total number of patches:", N_patches)
-    patches = np.empty((N_patches,full_imgs.shape[1],patch_h,patch_w))
-    patches_masks = np.empty((N_patches,full_masks.shape[1],patch_h,patch_w), dtype=np.uint8)
-    img_h = full_imgs.shape[2]  #height of the image
-    img_w = full_imgs.shape[3] #width of the image
-
-    iter_tot = 0   #iter over the total numbe rof patches (N_patches)
-    for i in range(full_imgs.shape[0]):  #loop over the all images
-        k=0
-        while k <patch_per_img:
-            x_center = random.randint(0+int(patch_w/2),img_w-int(patch_w/2))
-            y_center = random.randint(0+int(patch_h/2),img_h-int(patch_h/2))
-            #check whether the patch is contained in the FOV
-            if inside=='center' or inside == 'all':
-                if not is_patch_inside_FOV(x_center,y_center,full_FOVs[i,0],patch_h,patch_w,mode=inside):
-                    continue
-            patch = full_imgs[i,:,y_center-int(patch_h/2):y_center+int(patch_h/2),x_center-int(patch_w/2):x_center+int(patch_w/2)]
-            patch_mask = full_masks[i,:,y_center-int(patch_h/2):y_center+int(patch_h/2),x_center-int(patch_w/2):x_center+int(patch_w/2)]
-            patches[iter_tot]=patch
-            patches_masks[iter_tot]=patch_mask
-            iter_tot +=1   #total
-            k+=1  #per full_img
+    if patch_store is None:
+        patches = np.empty((N_patches,full_imgs.shape[1],patch_h,patch_w), dtype=full_imgs.dtype)
+        patches_masks = np.empty((N_patches,full_masks.shape[1],patch_h,patch_w), dtype=np.uint8)
+    else:
+        patches, patches_masks = create_patch_store(patch_store, N_patches, (full_imgs.shape[1],patch_h,patch_w),
+                                                    (full_masks.shape[1],patch_h,patch_w), full_imgs.dtype, shard_size)
+    if seed is None:
+        seed = np.random.randint(0, 2**31)
+    # patch_per_img centers per image, grouped by image
+    centers = PatchCenterSampler(full_FOVs, patch_h, patch_w, inside).sample(N_patches, seed, per_image=True, shuffle=False)
+    chunk = 4096  #number of patches gathered at once
+    for start in range(0, N_patches, chunk):
+        gather_patches(full_imgs, centers[start:start+chunk], patch_h, patch_w, out=patches, start=start)
+        gather_patches(full_masks, centers[start:start+chunk], patch_h, patch_w, out=patches_masks, start=start)
+    if patch_store is not None:
+        patches.flush()
+        patches_masks.flush()
     return patches, patches_masks
 
 def is_patch_inside_FOV(x,y,fov_img,patch_h,patch_w,mode='center'):
@@ -153,12 +282,10 @@ def data_dim_check(imgs,masks):
 # =============================Load test data==========================================
 # Load the original data and return the extracted patches for testing
 # return the ground truth in its original shape
-def get_data_test_overlap(test_data_path_list, patch_height, patch_width, stride_height, stride_width):
-    test_imgs_original, test_masks, test_FOVs= load_data(test_data_path_list)
-
-    test_imgs = my_PreProc(test_imgs_original)
-    test_masks = test_masks/255.
-    test_FOVs = test_FOVs//255
+# With prune=True, the patches without any FOV pixel are left out (see recompone_overlap)
+def get_data_test_overlap(test_data_path_list, patch_height, patch_width, stride_height, stride_width, cache_dir=None, num_workers=None, norm_stats=None, prune=False):
+    test_imgs, test_masks, test_FOVs, test_imgs_original = load_preprocessed_data(
+        test_data_path_list, cache_dir, keep_original=True, num_workers=num_workers, norm_stats=norm_stats)
     #extend both images and masks so they can be divided exactly by the patches dimensions
     test_imgs = paint_border_overlap(test_imgs, patch_height, patch_width, stride_height, stride_width)
 
@@ -168,9 +295,9 @@ def get_data_test_overlap(test_data_path_list, patch_height, patch_width, stride
         .format(test_imgs.shape, str(np.min(test_imgs)), str(np.max(test_imgs))))
 
     #extract the test patches from the all test images
-    patches_imgs_test = extract_ordered_overlap(test_imgs,patch_height,patch_width,stride_height,stride_width)
-    print("test patches shape: {}, value range ({} - {})"\
-        .format(patches_imgs_test.shape, str(np.min(patches_imgs_test)), str(np.max(patches_imgs_test))))
+    keep = FOV_window_mask(test_FOVs, test_imgs.shape[2], test_imgs.shape[3], patch_height, patch_width, stride_height, stride_width) if prune else None
+    patches_imgs_test = extract_ordered_overlap(test_imgs,patch_height,patch_width,stride_height,stride_width,keep)
+    print("test patches shape: {} (view of the test images)".format(patches_imgs_test.shape))
 
     return patches_imgs_test, test_imgs_original, test_masks, test_FOVs, test_imgs.shape[2], test_imgs.shape[3]
 
@@ -187,7 +314,7 @@ def paint_border_overlap(full_imgs, patch_h, patch_w, stride_h, stride_w):
         # print("img_h " +str(img_h) + ", patch_h " +str(patch_h) + ", stride_h " +str(stride_h))
         print("(img_h - patch_h) MOD stride_h: " +str(leftover_h))
         print("So the H dim will be padded with additional " +str(stride_h - leftover_h) + " pixels")
-        tmp_full_imgs = np.zeros((full_imgs.shape[0],full_imgs.shape[1],img_h+(stride_h-leftover_h),img_w))
+        tmp_full_imgs = np.zeros((full_imgs.shape[0],full_imgs.shape[1],img_h+(stride_h-leftover_h),img_w), dtype=full_imgs.dtype)
         tmp_full_imgs[0:full_imgs.shape[0],0:full_imgs.shape[1],0:img_h,0:img_w] = full_imgs
         full_imgs = tmp_full_imgs
     if (leftover_w != 0):   #change dimension of img_w
@@ -195,14 +322,68 @@ def paint_border_overlap(full_imgs, patch_h, patch_w, stride_h, stride_w):
         # print("img_w " +str(img_w) + ", patch_w " +str(patch_w) + ", stride_w " +str(stride_w))
         print("(img_w - patch_w) MOD stride_w: " +str(leftover_w))
         print("So the W dim will be padded with additional " +str(stride_w - leftover_w) + " pixels")
-        tmp_full_imgs = np.zeros((full_imgs.shape[0],full_imgs.shape[1],full_imgs.shape[2],img_w+(stride_w - leftover_w)))
+        tmp_full_imgs = np.zeros((full_imgs.shape[0],full_imgs.shape[1],full_imgs.shape[2],img_w+(stride_w - leftover_w)), dtype=full_imgs.dtype)
         tmp_full_imgs[0:full_imgs.shape[0],0:full_imgs.shape[1],0:full_imgs.shape[2],0:img_w] = full_imgs
         full_imgs = tmp_full_imgs
     print("new padded images shape: " +str(full_imgs.shape))
     return full_imgs
 
-# Extract test image patches in order and overlap
-def extract_ordered_overlap(full_imgs, patch_h, patch_w,stride_h,stride_w):
+class OverlapPatches():
+    """
+    Read-only (N_patches,C,patch_h,patch_w) array of the overlapping patches of full_imgs, in the order
+    image, row, column. It is a strided view of full_imgs (nothing is copied): indexing materializes
+    only the selected patches, e.g. one batch, and np.asarray() copies all of them.
+    If keep, a boolean [N, rows, cols] grid, is given, only the patches where it is True are included.
+    """
+    def __init__(self, full_imgs, patch_h, patch_w, stride_h, stride_w, keep=None):
+        self.full_imgs = full_imgs
+        self.patch_h, self.patch_w = patch_h, patch_w
+        self.stride_h, self.stride_w = stride_h, stride_w
+        self.keep = keep
+        self._make_windows()
+
+    def _make_windows(self):
+        windows = np.lib.stride_tricks.sliding_window_view(
+            np.asarray(self.full_imgs), (self.patch_h, self.patch_w), axis=(2,3))[:,:,::self.stride_h,::self.stride_w]
+        self.windows = windows.transpose(0,2,3,1,4,5)  # [N, rows, cols, C, patch_h, patch_w]
+        N, N_patches_h, N_patches_w, C = self.windows.shape[:4]
+        # the image, row and column axes cannot be merged in a view, patches are addressed by unravelled indices
+        self.grid = (N, N_patches_h, N_patches_w)
+        self.index = None if self.keep is None else np.flatnonzero(self.keep)  # positions in the grid of the included patches
+        N_patches = N*N_patches_h*N_patches_w if self.index is None else len(self.index)
+        self.shape = (N_patches, C, self.patch_h, self.patch_w)
+        self.dtype = self.windows.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            patches = self[key[0]]
+            rest = key[1:] if isinstance(key[0], (int, np.integer)) else (slice(None),)+key[1:]
+            return patches[rest]
+        idx = range(self.shape[0])[key] if isinstance(key, (int, np.integer)) else np.arange(self.shape[0])[key]
+        if self.index is not None:
+            idx = self.index[idx]
+        return self.windows[np.unravel_index(idx, self.grid)]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+    # DataLoader workers rebuild the view on the images instead of receiving a copy of all patches
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['windows']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_windows()
+
+# Extract test image patches in order and overlap, as a zero-copy OverlapPatches view of full_imgs
+# keep: optional boolean [N, rows, cols] grid of the patches to extract (e.g. FOV_window_mask)
+def extract_ordered_overlap(full_imgs, patch_h, patch_w,stride_h,stride_w,keep=None):
     assert (len(full_imgs.shape)==4)  #4D arrays
     assert (full_imgs.shape[1]==1 or full_imgs.shape[1]==3)  #check the channel is 1 or 3
     img_h = full_imgs.shape[2]  #height of the full image
@@ -213,19 +394,20 @@ def extract_ordered_overlap(full_imgs, patch_h, patch_w,stride_h,stride_w):
     print("Number of patches on h : " +str(((img_h-patch_h)//stride_h+1)))
     print("Number of patches on w : " +str(((img_w-patch_w)//stride_w+1)))
     print("number of patches per image: " +str(N_patches_img) +", totally for testset: " +str(N_patches_tot))
-    patches = np.empty((N_patches_tot,full_imgs.shape[1],patch_h,patch_w))
-    iter_tot = 0   #iter over the total number of patches (N_patches)
-    for i in range(full_imgs.shape[0]):  #loop over the full images
-        for h in range((img_h-patch_h)//stride_h+1):
-            for w in range((img_w-patch_w)//stride_w+1):
-                patch = full_imgs[i,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]
-                patches[iter_tot]=patch
-                iter_tot +=1   #total
-    assert (iter_tot==N_patches_tot)
+    patches = OverlapPatches(full_imgs, patch_h, patch_w, stride_h, stride_w, keep)
+    if keep is not None:
+        assert (keep.shape==patches.grid)
+        print("patches without FOV pixels skipped: {} of {}".format(N_patches_tot-len(patches), N_patches_tot))
+    else:
+        assert (len(patches)==N_patches_tot)
     return patches  #array with all the full_imgs divided in patches
 
 # recompone the prediction result patches to images
-def recompone_overlap(preds, img_h, img_w, stride_h, stride_w):
+# Each patch position is overlap-added for all images at once, and the number of predictions
+# of each pixel, the same for every image, is only counted once.
+# If only the patches of the boolean [N, rows, cols] grid keep were predicted, the predictions
+# are counted per image, and the pixels not covered by any of them (outside the FOV) are set to 0
+def recompone_overlap(preds, img_h, img_w, stride_h, stride_w, keep=None):
     assert (len(preds.shape)==4)  #4D arrays
     assert (preds.shape[1]==1 or preds.shape[1]==3)  #check the channel is 1 or 3
     patch_h = preds.shape[2]
@@ -236,20 +418,19 @@ def recompone_overlap(preds, img_h, img_w, stride_h, stride_w):
     # print("N_patches_h: " + str(N_patches_h))
     # print("N_patches_w: " + str(N_patches_w))
     # print("N_patches_img: " + str(N_patches_img))
+    if keep is not None:
+        return recompone_kept(preds, keep, img_h, img_w, stride_h, stride_w)
     assert (preds.shape[0]%N_patches_img==0)
     N_full_imgs = preds.shape[0]//N_patches_img
     print("There are " +str(N_full_imgs) +" images in Testset")
-    full_prob = np.zeros((N_full_imgs,preds.shape[1],img_h,img_w))
-    full_sum = np.zeros((N_full_imgs,preds.shape[1],img_h,img_w))
-
-    k = 0 #iterator over all the patches
-    for i in range(N_full_imgs):
-        for h in range((img_h-patch_h)//stride_h+1):
-            for w in range((img_w-patch_w)//stride_w+1):
-                full_prob[i,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]+=preds[k] # Accumulate predicted values
-                full_sum[i,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]+=1  # Accumulate the number of predictions
-                k+=1
-    assert(k==preds.shape[0])
+    preds = np.asarray(preds).reshape((N_full_imgs,N_patches_h,N_patches_w)+preds.shape[1:])
+    full_prob = np.zeros((N_full_imgs,preds.shape[3],img_h,img_w))
+    full_sum = np.zeros((1,1,img_h,img_w))
+
+    for h in range(N_patches_h):
+        for w in range(N_patches_w):
+            full_prob[:,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]+=preds[:,h,w] # Accumulate predicted values
+            full_sum[:,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]+=1  # Accumulate the number of predictions
     assert(np.min(full_sum)>=1.0) 
     final_avg = full_prob/full_sum # Take the average
     # print(final_avg.shape)
@@ -257,34 +438,69 @@ def recompone_overlap(preds, img_h, img_w, stride_h, stride_w):
     assert(np.min(final_avg)>=0.0) # min value for a pixel is 0.0
     return final_avg
 
+# recompone_overlap of the predictions of the patches of the grid keep only, in the order image, row, column
+def recompone_kept(preds, keep, img_h, img_w, stride_h, stride_w):
+    patch_h = preds.shape[2]
+    patch_w = preds.shape[3]
+    N_full_imgs, N_patches_h, N_patches_w = keep.shape
+    assert (N_patches_h==(img_h-patch_h)//stride_h+1 and N_patches_w==(img_w-patch_w)//stride_w+1)
+    assert (preds.shape[0]==np.count_nonzero(keep))
+    print("There are " +str(N_full_imgs) +" images in Testset")
+    # index of the prediction of each patch of the grid, -1 if it was skipped
+    slot = np.full(keep.size, -1)
+    slot[np.flatnonzero(keep)] = np.arange(preds.shape[0])
+    slot = slot.reshape(keep.shape)
+    preds = np.asarray(preds)
+    full_prob = np.zeros((N_full_imgs,preds.shape[1],img_h,img_w))
+    full_sum = np.zeros((N_full_imgs,1,img_h,img_w))
+
+    for h in range(N_patches_h):
+        for w in range(N_patches_w):
+            imgs = np.flatnonzero(slot[:,h,w]>=0)
+            if len(imgs) == 0:
+                continue
+            full_prob[imgs,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]+=preds[slot[imgs,h,w]] # Accumulate predicted values
+            full_sum[imgs,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]+=1  # Accumulate the number of predictions
+    final_avg = np.divide(full_prob, full_sum, out=np.zeros_like(full_prob), where=full_sum>0) # uncovered pixels stay 0
+    assert(np.max(final_avg)<=1.0) # max value for a pixel is 1.0
+    assert(np.min(final_avg)>=0.0) # min value for a pixel is 0.0
+    return final_avg
+
 #return only the predicted pixels contained in the FOV, for both images and masks
+# as [N_pixels, C] arrays, ordered by image, then column, then row
 def pred_only_in_FOV(data_imgs,data_masks,FOVs):
     assert (len(data_imgs.shape)==4 and len(data_masks.shape)==4)  #4D arrays
-    height = data_imgs.shape[2]
-    width = data_imgs.shape[3]
-    new_pred_imgs = []
-    new_pred_masks = []
-    for i in range(data_imgs.shape[0]):  #loop over the all test images
-        for x in range(width):
-            for y in range(height):
-                if pixel_inside_FOV(i,x,y,FOVs):
-                    new_pred_imgs.append(data_imgs[i,:,y,x])
-                    new_pred_masks.append(data_masks[i,:,y,x])
-    new_pred_imgs = np.asarray(new_pred_imgs)
-    new_pred_masks = np.asarray(new_pred_masks)
+    inside = FOV_mask(FOVs, data_imgs.shape).transpose(0,2,1)  # [N,W,H]
+    new_pred_imgs = np.asarray(data_imgs).transpose(0,3,2,1)[inside]
+    new_pred_masks = np.asarray(data_masks).transpose(0,3,2,1)[inside]
     return new_pred_imgs, new_pred_masks
 
 # Set the pixel value outside FOV to 0, only for visualization
 def kill_border(data, FOVs):
     assert (len(data.shape)==4)  #4D arrays
     assert (data.shape[1]==1 or data.shape[1]==3)  #check the channel is 1 or 3
-    height = data.shape[2]
-    width = data.shape[3]
-    for i in range(data.shape[0]):  #loop over the full images
-        for x in range(width):
-            for y in range(height):
-                if not pixel_inside_FOV(i,x,y,FOVs):
-                    data[i,:,y,x]=0.0
+    outside = ~FOV_mask(FOVs, data.shape)
+    data[np.broadcast_to(outside[:,None], data.shape)] = 0.0
+
+# Boolean [N,H,W] map of the pixels of [N,C,H,W] data inside the FOV, pixels beyond the FOVs are outside
+def FOV_mask(FOVs, shape):
+    assert (len(FOVs.shape)==4)  #4D arrays
+    assert (FOVs.shape[1]==1)
+    height, width = min(shape[2], FOVs.shape[2]), min(shape[3], FOVs.shape[3])
+    inside = np.zeros((shape[0], shape[2], shape[3]), dtype=bool)
+    inside[:,:height,:width] = np.asarray(FOVs[:shape[0],0,:height,:width]) > 0 #0==black pixels
+    return inside
+
+# Boolean [N, rows, cols] grid of the overlapping patches (as extract_ordered_overlap) of padded
+# img_h x img_w images that contain at least one FOV pixel, counted with a summed-area table
+def FOV_window_mask(FOVs, img_h, img_w, patch_h, patch_w, stride_h, stride_w):
+    inside = FOV_mask(FOVs, (FOVs.shape[0], 1, img_h, img_w))
+    sat = np.zeros((inside.shape[0], img_h+1, img_w+1), dtype=np.int64)
+    np.cumsum(np.cumsum(inside, axis=1), axis=2, out=sat[:,1:,1:])
+    ys = np.arange(0, img_h-patch_h+1, stride_h)[:,None]
+    xs = np.arange(0, img_w-patch_w+1, stride_w)[None,:]
+    counts = sat[:,ys+patch_h,xs+patch_w] - sat[:,ys,xs+patch_w] - sat[:,ys+patch_h,xs] + sat[:,ys,xs]
+    return counts > 0
 
 # function to judge pixel(x,y) in FOV or not
 def pixel_inside_FOV(i, x, y, FOVs):
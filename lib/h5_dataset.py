@@ -0,0 +1,86 @@
+"""
+HDF5 storage of a preprocessed data set.
+One file holds the preprocessed imgs, the binary GTs and FOVs (and optionally the original
+imgs) as chunked, compressed [N,C,H,W] datasets. Training reads it lazily, so that only
+the chunks touched by a patch are decoded.
+"""
+import os
+import json
+import h5py
+
+H5_EXTENSIONS = ('.h5', '.hdf5')
+
+def is_hdf5(data_path):
+    return str(data_path).lower().endswith(H5_EXTENSIONS)
+
+# Write [N,C,H,W] arrays into one file, chunked per image in chunk_size x chunk_size tiles
+def write_hdf5(h5_path, arrays, attrs=None, chunk_size=64, compression='gzip'):
+    with h5py.File(h5_path, 'w') as f:
+        for name, arr in arrays.items():
+            N, C, H, W = arr.shape
+            chunks = (1, C, min(chunk_size, H), min(chunk_size, W))
+            f.create_dataset(name, data=arr, chunks=chunks, compression=compression, shuffle=True)
+        for key, value in (attrs or {}).items():
+            f.attrs[key] = value if isinstance(value, (str, int, float)) else json.dumps(value)
+
+# Attribute key of a HDF5 file (decoded from JSON if it was stored as such), None if it has none
+def read_hdf5_attr(h5_path, key):
+    with h5py.File(h5_path, 'r') as f:
+        if key not in f.attrs:
+            return None
+        value = f.attrs[key]
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return value
+
+class H5Array():
+    """
+    Read-only numpy-like view of a dataset in an HDF5 file.
+    The file is opened on first access in each process, so the object can be
+    handed to DataLoader workers.
+    """
+    def __init__(self, h5_path, name, rdcc_nbytes=64*1024**2):
+        self.h5_path = h5_path
+        self.name = name
+        self.rdcc_nbytes = rdcc_nbytes
+        self._file = None
+        self._pid = None
+        with h5py.File(h5_path, 'r') as f:
+            self.shape = f[name].shape
+            self.dtype = f[name].dtype
+
+    def _dataset(self):
+        if self._file is None or self._pid != os.getpid():
+            self._file = h5py.File(self.h5_path, 'r', rdcc_nbytes=self.rdcc_nbytes)
+            self._pid = os.getpid()
+        return self._file[self.name]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self._dataset()[key]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self._dataset()[()]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+def hdf5_names(h5_path):
+    with h5py.File(h5_path, 'r') as f:
+        return list(f.keys())
+
+# Open the arrays of an HDF5 data set, lazily for the names in lazy_names and in memory otherwise
+def load_hdf5(h5_path, names, lazy_names=()):
+    with h5py.File(h5_path, 'r') as f:
+        missing = [name for name in names if name not in f]
+        if missing:
+            raise ValueError("{} has no dataset {}".format(h5_path, missing))
+        arrays = {name: f[name][()] for name in names if name not in lazy_names}
+    arrays.update({name: H5Array(h5_path, name) for name in names if name in lazy_names})
+    return arrays
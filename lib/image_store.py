@@ -0,0 +1,115 @@
+"""
+Lazily loaded training images for data sets larger than the memory.
+The images of a data path list are decoded and preprocessed on first access only and
+kept in an LRU cache bounded in MB. Patches should then be drawn image by image
+(see GroupedPatchSampler) so that most accesses hit the cache.
+"""
+from collections import OrderedDict
+import numpy as np
+from torch.utils.data import Sampler
+
+from .extract_patches import load_file_path_txt, read_array
+from .pre_processing import my_PreProc
+
+class LazyImageStore():
+    """
+    Preprocessed imgs, binary (0/1) GTs and FOVs of a data path list, exposed as the
+    [N,1,H,W] LazyArray fields imgs, masks and fovs. All images must have the same size.
+    Every process (e.g. DataLoader worker) has its own cache of at most cache_mb MB.
+    """
+    def __init__(self, data_path_list, cache_mb=1024):
+        self.data_path_list = data_path_list
+        self.paths = dict(zip(('imgs', 'masks', 'fovs'), load_file_path_txt(data_path_list)))
+        self.cache_bytes = int(cache_mb * 1024**2)
+        self._cache = OrderedDict()
+        self._size = 0
+        self.hits, self.misses = 0, 0
+        img_h, img_w = read_array(self.paths['fovs'][0], single_channel=True).shape
+        shape = (len(self.paths['imgs']), 1, img_h, img_w)
+        print('\033[0;33mlazy image store of {} < shape:{} cache:{}MB \033[0m'.format(data_path_list, shape, cache_mb))
+        self.imgs, self.masks, self.fovs = [LazyArray(self, name, shape) for name in ('imgs', 'masks', 'fovs')]
+
+    # Load and preprocess image n of the field name, as a [1,H,W] uint8 array
+    def _load(self, name, n):
+        path = self.paths[name][n]
+        if name == 'imgs':
+            img = np.transpose(read_array(path), (2,0,1))[None]
+            return my_PreProc(img)[0]
+        arr = read_array(path, single_channel=True)
+        if name == 'masks' and np.max(arr) == 1:  # single channel binary GT (CHASE_DB1)
+            arr = arr * 255
+        return (arr//255).astype(np.uint8)[None]
+
+    def get(self, name, n):
+        key = (name, n)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.misses += 1
+        arr = self._load(name, n)
+        if arr.shape[1:] != self.imgs.shape[2:]:
+            raise ValueError("Shape {} of {} is different from shape {} of the first sample".format(arr.shape[1:], self.paths[name][n], self.imgs.shape[2:]))
+        self._cache[key] = arr
+        self._size += arr.nbytes
+        while self._size > self.cache_bytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self._size -= old.nbytes
+        return arr
+
+    # DataLoader workers start with an empty cache instead of a pickled copy
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        state['_size'] = 0
+        return state
+
+class LazyArray():
+    """
+    Read-only [N,1,H,W] numpy-like view of a field of a LazyImageStore.
+    Indexing loads the images it touches, e.g. arr[n,:,y0:y1,x0:x1] only loads image n.
+    """
+    def __init__(self, store, name, shape):
+        self.store = store
+        self.name = name
+        self.shape = shape
+        self.dtype = np.dtype(np.uint8)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if isinstance(key[0], (int, np.integer)):
+            return self.store.get(self.name, int(key[0]))[key[1:]]
+        return np.stack([self.store.get(self.name, n) for n in range(self.shape[0])[key[0]]])[(slice(None),)+key[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+class GroupedPatchSampler(Sampler):
+    """
+    Order the patches (rows [n, x_center, y_center] of patches_idx) by groups of images_per_group
+    images: all patches of a group are visited (shuffled among themselves) before the next group,
+    so a LazyImageStore only needs to hold about images_per_group images.
+    With shuffle=False, the patches are visited image by image in their original order.
+    """
+    def __init__(self, patches_idx, images_per_group=8, shuffle=True, seed=2021):
+        self.img_idx = np.asarray(patches_idx)[:,0]
+        self.images_per_group = images_per_group
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)  # advances every epoch
+
+    def __len__(self):
+        return len(self.img_idx)
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(np.argsort(self.img_idx, kind='stable').tolist())
+        images = self.rng.permutation(np.unique(self.img_idx))
+        # rank of the group of each patch, ties (same group) broken by a random key
+        group_of_img = np.empty(self.img_idx.max()+1, dtype=np.int64)
+        group_of_img[images] = np.arange(len(images)) // self.images_per_group
+        order = np.lexsort((self.rng.random(len(self.img_idx)), group_of_img[self.img_idx]))
+        return iter(order.tolist())
@@ -0,0 +1,149 @@
+"""
+Inference on full test images, one image at a time.
+sliding_window_predict cuts the overlapping windows of an image on the fly, predicts them
+batch by batch and adds them to the probability map of that image right away, so the patches
+are never stored: the overhead over the images themselves is one image's maps and one batch,
+instead of growing with the overlap of the windows. The test images and the predicted maps
+of the whole test set are still held by Test, as the evaluation needs all of them.
+WholeImagePredictor runs fully convolutional nets on the whole image in one pass.
+"""
+import numpy as np
+import torch
+
+from .common import to_model_input
+from .extract_patches import FOV_window_mask
+
+# Zero-pad a [C,H,W] image at the bottom/right so that the windows exactly cover it (as paint_border_overlap)
+def pad_to_windows(img, patch_h, patch_w, stride_h, stride_w):
+    img_h, img_w = img.shape[1:]
+    pad_h = (stride_h - (img_h-patch_h) % stride_h) % stride_h
+    pad_w = (stride_w - (img_w-patch_w) % stride_w) % stride_w
+    if pad_h == 0 and pad_w == 0:
+        return img
+    return np.pad(img, ((0,0),(0,pad_h),(0,pad_w)))
+
+# Top-left corners [y, x] of the windows of a padded image, in row-major order
+def window_positions(img_h, img_w, patch_h, patch_w, stride_h, stride_w):
+    ys = np.arange(0, img_h-patch_h+1, stride_h)
+    xs = np.arange(0, img_w-patch_w+1, stride_w)
+    return np.stack(np.meshgrid(ys, xs, indexing='ij'), axis=-1).reshape(-1, 2)
+
+# Add the predicted [B,C,h,w] windows at positions to the probability sums and the prediction counts of the image
+def accumulate(prob, count, preds, positions):
+    patch_h, patch_w = preds.shape[2:]
+    for pred, (y, x) in zip(preds, positions):
+        prob[:, y:y+patch_h, x:x+patch_w] += pred
+        count[:, y:y+patch_h, x:x+patch_w] += 1
+
+# Positions of the windows that contain at least one pixel of the [1,H,W] FOV
+def prune_positions(positions, fov, img_h, img_w, patch_h, patch_w, stride_h, stride_w):
+    keep = FOV_window_mask(np.asarray(fov)[None], img_h, img_w, patch_h, patch_w, stride_h, stride_w)
+    return positions[keep.reshape(-1)]
+
+# Vessel probability map [1,H,W] of one preprocessed [C,H,W] image, averaged over the overlapping windows.
+# If its [1,H,W] FOV is given, the windows without FOV pixels are skipped and the pixels they alone cover are 0
+def sliding_window_predict(net, img, patch_h, patch_w, stride_h, stride_w, batch_size=64, device=None, fov=None):
+    img_h, img_w = img.shape[1:]
+    img = pad_to_windows(np.asarray(img), patch_h, patch_w, stride_h, stride_w)
+    positions = window_positions(img.shape[1], img.shape[2], patch_h, patch_w, stride_h, stride_w)
+    if fov is not None:
+        positions = prune_positions(positions, fov, img.shape[1], img.shape[2], patch_h, patch_w, stride_h, stride_w)
+    windows = np.lib.stride_tricks.sliding_window_view(img, (patch_h, patch_w), axis=(1,2))  # [C,H',W',h,w]
+    prob = np.zeros((1,)+img.shape[1:])
+    count = np.zeros((1,)+img.shape[1:])
+    with torch.no_grad():
+        for start in range(0, len(positions), batch_size):
+            pos = positions[start:start+batch_size]
+            batch = np.ascontiguousarray(windows[:, pos[:,0], pos[:,1]].transpose(1,0,2,3))  # [B,C,h,w]
+            outputs = net(to_model_input(torch.from_numpy(batch), device))
+            accumulate(prob, count, outputs[:,1:2].cpu().numpy(), pos)
+    prob = np.divide(prob, count, out=prob, where=count>0)
+    return prob[:, :img_h, :img_w]
+
+# Smallest factor by which the net downsamples its input (e.g. 2**depth), measured on a probe input:
+# the input size of a fully convolutional net should be a multiple of it. Set net.size_divisor to override
+def infer_size_divisor(net, in_channels=1, probe=256, device=None):
+    if hasattr(net, 'size_divisor'):
+        return net.size_divisor
+    sizes = []
+    hooks = [m.register_forward_hook(lambda m, i, o: sizes.append(o.shape[-1]) if torch.is_tensor(o) and o.dim()==4 else None)
+             for m in net.modules()]
+    try:
+        with torch.no_grad():
+            net(torch.zeros((1, in_channels, probe, probe), device=device))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return probe // min(sizes)
+
+# Radius of the receptive field of the output pixels, estimated from the extent of the input gradient of a center pixel.
+# The probe size is doubled (up to max_probe) while the gradient reaches its border
+def estimate_receptive_radius(net, in_channels=1, probe=256, device=None, max_probe=1024):
+    inputs = torch.zeros((1, in_channels, probe, probe), device=device, requires_grad=True)
+    net(inputs)[0, 1, probe//2, probe//2].backward()
+    net.zero_grad(set_to_none=True)
+    rows, cols = np.nonzero(inputs.grad[0].abs().sum(0).cpu().numpy())
+    if len(rows) == 0:
+        return probe // 2
+    radius = int(max(probe//2 - rows.min(), rows.max() - probe//2, probe//2 - cols.min(), cols.max() - probe//2))
+    if radius >= probe//2 - 1 and probe < max_probe:
+        return estimate_receptive_radius(net, in_channels, probe*2, device, max_probe)
+    return radius
+
+def is_out_of_memory(e):
+    return isinstance(e, RuntimeError) and ('out of memory' in str(e) or "can't allocate memory" in str(e))
+
+class WholeImagePredictor():
+    """
+    Vessel probability maps of full preprocessed [C,H,W] images with a fully convolutional net:
+    the image is zero-padded to a multiple of the size divisor of the net, predicted in one
+    forward pass and cropped back. If that runs out of memory, the image (and the following ones)
+    is predicted in tile_size x tile_size tiles, each with a halo of the receptive field radius
+    of the net, aligned on the size divisor so that the tiles see the same context as the whole image.
+    """
+    def __init__(self, net, device=None, tile_size=512, in_channels=1):
+        self.net = net
+        self.device = device
+        self.in_channels = in_channels
+        self.size_divisor = infer_size_divisor(net, in_channels, device=device)
+        self.tile_size = int(np.ceil(tile_size / self.size_divisor)) * self.size_divisor
+        self.halo = None  # estimated when the tiles are first needed
+        self.tiled = False
+
+    # Prediction of one [C,H,W] image in one forward pass
+    def _predict(self, img):
+        img_h, img_w = img.shape[1:]
+        pad_h, pad_w = (-img_h) % self.size_divisor, (-img_w) % self.size_divisor
+        img = np.pad(img, ((0,0),(0,pad_h),(0,pad_w)))
+        with torch.no_grad():
+            outputs = self.net(to_model_input(torch.from_numpy(img[None]), self.device))
+        return outputs[0, 1:2, :img_h, :img_w].cpu().numpy().astype(np.float64)
+
+    def _predict_tiled(self, img):
+        if self.halo is None:
+            radius = estimate_receptive_radius(self.net, self.in_channels, device=self.device)
+            self.halo = int(np.ceil(radius / self.size_divisor)) * self.size_divisor
+            print("tiled inference: tiles of {} px with a halo of {} px".format(self.tile_size, self.halo))
+        img_h, img_w = img.shape[1:]
+        pred = np.empty((1, img_h, img_w))
+        for y in range(0, img_h, self.tile_size):
+            for x in range(0, img_w, self.tile_size):
+                y0, x0 = max(0, y-self.halo), max(0, x-self.halo)
+                y1, x1 = min(img_h, y+self.tile_size+self.halo), min(img_w, x+self.tile_size+self.halo)
+                tile = self._predict(img[:, y0:y1, x0:x1])
+                pred[:, y:y+self.tile_size, x:x+self.tile_size] = tile[:, y-y0:y-y0+self.tile_size, x-x0:x-x0+self.tile_size]
+        return pred
+
+    def __call__(self, img):
+        img = np.asarray(img)
+        if not self.tiled:
+            try:
+                return self._predict(img)
+            except RuntimeError as e:
+                if not is_out_of_memory(e):
+                    raise
+                print("\033[0;31mOut of memory on a whole {} image, falling back to tiles\033[0m".format(img.shape))
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                self.tiled = True
+        return self._predict_tiled(img)
@@ -32,9 +32,14 @@ class Evaluate():
         self.threshold_confusion = 0.5
 
     # Add data pair (target and predicted value)
-    def add_batch(self,batch_tar,batch_out):
-        batch_tar = batch_tar.flatten()
-        batch_out = batch_out.flatten()
+    # mask (optional): boolean array of the shape of the batch, only the selected pixels are added (e.g. the FOV)
+    def add_batch(self,batch_tar,batch_out,mask=None):
+        if mask is None:
+            batch_tar = batch_tar.flatten()
+            batch_out = batch_out.flatten()
+        else:
+            batch_tar = np.asarray(batch_tar)[mask]
+            batch_out = np.asarray(batch_out)[mask]
 
         self.target = batch_tar if self.target is None else np.concatenate((self.target,batch_tar))
         self.output = batch_out if self.output is None else np.concatenate((self.output,batch_out))
@@ -0,0 +1,129 @@
+"""
+Vectorized sampling of training patch positions.
+The valid patch centers of every image are precomputed once (with a summed-area table
+of the FOV for the 'all' mode), then any number of centers is drawn in one call from a
+seeded numpy Generator instead of a rejection loop.
+Optionally, the centers are split into strata by the vessel density of the patch
+(from a summed-area table of the GT) and drawn with a fixed ratio per stratum.
+"""
+import numpy as np
+
+# Summed-area table of a 2D array, padded with a leading row and column of zeros
+def integral_image(img):
+    sat = np.zeros((img.shape[0]+1, img.shape[1]+1), dtype=np.int64)
+    np.cumsum(img, axis=0, out=sat[1:,1:])
+    np.cumsum(sat[1:,1:], axis=1, out=sat[1:,1:])
+    return sat
+
+# Sums of all win_h x win_w windows, indexed by the top-left corner of the window
+def window_sums(sat, win_h, win_w):
+    return sat[win_h:,win_w:] - sat[:-win_h,win_w:] - sat[win_h:,:-win_w] + sat[:-win_h,:-win_w]
+
+# Strata of vessel density, see PatchCenterSampler
+STRATA = ('vessel-rich', 'mixed', 'background')
+
+class PatchCenterSampler():
+    """
+    Draw patch centers (n, x_center, y_center) of patch_h x patch_w patches.
+    inside_FOV: 'not' (any position), 'center' (center pixel in the FOV) or 'all' (whole patch in the FOV)
+    masks, density_thresholds: if given, the valid centers are split into the STRATA by the
+    fraction d of vessel pixels in the patch: vessel-rich (d >= thresholds[0]),
+    mixed (thresholds[1] <= d < thresholds[0]) and background (d < thresholds[1]),
+    strata_ratio is then the default fraction of patches drawn from each stratum.
+    Only the index of the valid centers is kept, not fovs and masks, so the sampler is cheap
+    to send to DataLoader workers.
+    """
+    def __init__(self, fovs, patch_h, patch_w, inside_FOV='center', masks=None, density_thresholds=None, strata_ratio=None):
+        assert len(fovs.shape)==4
+        if inside_FOV not in ('not', 'center', 'all'):
+            raise ValueError("\033[0;31minside_FOV should be one of [not,center,all], got {}\033[0m".format(inside_FOV))
+        self.patch_h, self.patch_w = int(patch_h), int(patch_w)
+        self.half_h, self.half_w = int(self.patch_h/2), int(self.patch_w/2)
+        self.inside_FOV = inside_FOV
+        N, _, img_h, img_w = fovs.shape
+        # the top-left corner of a patch lies in a box of box_h x box_w positions
+        self.box_h, self.box_w = img_h-self.patch_h+1, img_w-self.patch_w+1
+        assert self.box_h > 0 and self.box_w > 0, "patch is larger than the image"
+        self.density_thresholds = density_thresholds
+        self.strata_ratio = strata_ratio
+        # index[n][s]: flat positions (in the box) of the valid corners of stratum s in image n
+        self.index = [self.stratify(masks, n, np.flatnonzero(self.valid_corners(fovs, n))) for n in range(N)]
+        self.counts = np.array([[len(idx) for idx in strata] for strata in self.index]) # (N, n_strata)
+
+    # Boolean map (box_h, box_w) of the valid top-left corners of the patches of image n
+    def valid_corners(self, fovs, n):
+        if self.inside_FOV == 'not':
+            return np.ones((self.box_h, self.box_w), dtype=bool)
+        fov = np.asarray(fovs[n][0]) > 0
+        if self.inside_FOV == 'center':
+            return fov[self.half_h:self.half_h+self.box_h, self.half_w:self.half_w+self.box_w]
+        return window_sums(integral_image(fov), self.patch_h, self.patch_w) == self.patch_h*self.patch_w
+
+    # Split the valid corners of image n into the density strata (a single stratum without masks)
+    def stratify(self, masks, n, flat):
+        if masks is None or self.density_thresholds is None:
+            return [flat]
+        mask = np.asarray(masks[n][0]) > 0
+        density = (window_sums(integral_image(mask), self.patch_h, self.patch_w) / (self.patch_h*self.patch_w)).ravel()[flat]
+        high, low = self.density_thresholds
+        return [flat[density >= high], flat[(density >= low) & (density < high)], flat[density < low]]
+
+    # Number of patches of each stratum, redistributing the share of empty strata to the others
+    def _patches_per_stratum(self, N_patches, ratios):
+        ratios = np.asarray(ratios, dtype=float) * (self.counts.sum(axis=0) > 0)
+        if len(ratios) != self.counts.shape[1] or ratios.sum() == 0:
+            raise ValueError("\033[0;31mInvalid strata ratios {} for strata counts {}\033[0m".format(ratios, self.counts.sum(axis=0)))
+        exact = N_patches * ratios / ratios.sum()
+        k = np.floor(exact).astype(np.int64)
+        k[np.argsort(k-exact)[:N_patches-k.sum()]] += 1  # largest remainders
+        return k
+
+    # Number of patches of stratum s drawn from each image
+    def _patches_per_image(self, N_patches, rng, per_image, s=0):
+        if per_image:
+            return np.full(len(self.counts), N_patches//len(self.counts))
+        total = self.counts[:,s].sum()
+        if N_patches == 0:
+            return np.zeros(len(self.counts), dtype=np.int64)
+        if total == 0:
+            raise ValueError("\033[0;31mThere is no valid patch position in the images\033[0m")
+        return rng.multinomial(N_patches, self.counts[:,s]/total)
+
+    def sample(self, N_patches, rng=None, per_image=False, shuffle=True, strata_ratio=None):
+        """
+        Return an (N_patches,3) array of [n, x_center, y_center].
+        per_image=True draws N_patches//N patches from every image (grouped by image if shuffle=False),
+        otherwise the centers are drawn uniformly among all valid positions of all images.
+        strata_ratio gives the fraction of patches of each of the STRATA (stratified sampler only).
+        """
+        rng = np.random.default_rng(rng)
+        strata_ratio = self.strata_ratio if strata_ratio is None else strata_ratio
+        if strata_ratio is None:
+            assert self.counts.shape[1] == 1, "strata_ratio is required by a stratified sampler"
+            k = self._patches_per_image(N_patches, rng, per_image)[:,None]
+        else:
+            assert not per_image, "stratified sampling draws over all images"
+            k_strata = self._patches_per_stratum(N_patches, strata_ratio)
+            k = np.stack([self._patches_per_image(k_strata[s], rng, False, s) for s in range(len(k_strata))], axis=1)
+        res = np.empty((k.sum(),3), dtype=np.int64)
+        start = 0
+        for n, s in zip(*np.nonzero(k)):
+            if self.counts[n,s] == 0:
+                raise ValueError("\033[0;31mThere is no valid patch position in image {}\033[0m".format(n))
+            flat = self.index[n][s][rng.integers(0, self.counts[n,s], size=k[n,s])]
+            res[start:start+k[n,s],0] = n
+            res[start:start+k[n,s],1] = flat % self.box_w + self.half_w
+            res[start:start+k[n,s],2] = flat // self.box_w + self.half_h
+            start += k[n,s]
+        if shuffle:
+            res = res[rng.permutation(len(res))]
+        return res
+
+# Gather the patches at the sampled centers into out[start:start+len(centers)] with one indexing call
+def gather_patches(full_imgs, centers, patch_h, patch_w, out=None, start=0):
+    windows = np.lib.stride_tricks.sliding_window_view(np.asarray(full_imgs), (patch_h, patch_w), axis=(2,3))
+    patches = windows[centers[:,0], :, centers[:,2]-int(patch_h/2), centers[:,1]-int(patch_w/2)]
+    if out is None:
+        return patches
+    out[start:start+len(centers)] = patches
+    return out
@@ -0,0 +1,89 @@
+"""
+On-disk store of training patches.
+The patches are written into fixed-size memory-mapped .npy shards, so that a large
+number of patches does not have to fit in memory; the OS only keeps the pages in use.
+"""
+import os
+import numpy as np
+
+class ShardedArray():
+    """
+    Array of shape (N,...) split along the first axis into memory-mapped .npy shards
+    of shard_size rows. Supports integer and slice indexing along the first axis, followed
+    by any numpy indexing of the other axes, e.g. arr[0:50, :, :, :].
+    """
+    def __init__(self, shards, shard_size):
+        self.shards = shards
+        self.shard_size = shard_size
+        self.shape = (sum(len(s) for s in shards),) + shards[0].shape[1:]
+        self.dtype = shards[0].dtype
+
+    @classmethod
+    def create(cls, path, prefix, shape, dtype, shard_size):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in os.listdir(path):  # shards of a previous run
+            if name.startswith(prefix+'_') and name.endswith('.npy'):
+                os.remove(os.path.join(path, name))
+        shards = []
+        for i, start in enumerate(range(0, shape[0], shard_size)):
+            rows = min(shard_size, shape[0]-start)
+            shards.append(np.lib.format.open_memmap(os.path.join(path, '%s_%05d.npy' % (prefix, i)),
+                                                    mode='w+', dtype=dtype, shape=(rows,)+tuple(shape[1:])))
+        return cls(shards, shard_size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _ranges(self, key):
+        # split a slice of rows into (shard, start, stop, out_start) pieces
+        start, stop, step = key.indices(self.shape[0])
+        assert step == 1, "only contiguous slices are supported"
+        pos = start
+        while pos < stop:
+            shard, offset = divmod(pos, self.shard_size)
+            end = min(stop, (shard+1)*self.shard_size)
+            yield shard, offset, offset+end-pos, pos-start
+            pos = end
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = self[key[0]]
+            rest = key[1:] if isinstance(key[0], (int, np.integer)) else (slice(None),)+key[1:]
+            return rows[rest]
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(self.shape[0])
+            out = np.empty((max(stop-start, 0),)+self.shape[1:], dtype=self.dtype)
+            for shard, s, e, o in self._ranges(key):
+                out[o:o+e-s] = self.shards[shard][s:e]
+            return out
+        shard, offset = divmod(int(key), self.shard_size)
+        return self.shards[shard][offset]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            for shard, s, e, o in self._ranges(key):
+                self.shards[shard][s:e] = value[o:o+e-s]
+        else:
+            shard, offset = divmod(int(key), self.shard_size)
+            self.shards[shard][offset] = value
+
+    # DataLoader workers reopen the shards read-only instead of receiving a pickled copy
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = [shard.filename for shard in self.shards]
+        return state
+
+    def __setstate__(self, state):
+        state['shards'] = [np.load(filename, mmap_mode='r') for filename in state['shards']]
+        self.__dict__.update(state)
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+# Create the memory-mapped image and mask shards of N_patches patches in path
+def create_patch_store(path, N_patches, img_shape, mask_shape, img_dtype, shard_size=10000):
+    patches_imgs = ShardedArray.create(path, 'imgs', (N_patches,)+tuple(img_shape), img_dtype, shard_size)
+    patches_masks = ShardedArray.create(path, 'masks', (N_patches,)+tuple(mask_shape), np.uint8, shard_size)
+    return patches_imgs, patches_masks
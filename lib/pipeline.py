@@ -0,0 +1,75 @@
+"""
+Thread pipeline of processing stages connected by bounded queues, used by segment.py.
+Every stage runs its function in its own worker threads, so the stages overlap (e.g. the
+next images are decoded and preprocessed while the model predicts the current one), and
+the bounded queues keep the fast stages from running ahead of the slow ones.
+"""
+import time
+import queue
+import threading
+
+_DONE = object()  # end of the items, passed from stage to stage
+
+class Stage():
+    """Function applied to every item by `workers` threads. Returning None drops the item"""
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.busy = 0.0  # seconds spent in fn, summed over the workers
+        self.items = 0
+        self._lock = threading.Lock()
+        self._running = workers
+
+    def _work(self, in_queue, out_queue, errors):
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                in_queue.put(_DONE)  # for the sibling workers
+                with self._lock:
+                    self._running -= 1
+                    last = self._running == 0
+                if last:
+                    out_queue.put(_DONE)
+                return
+            start = time.perf_counter()
+            try:
+                res = self.fn(item)
+            except Exception as e:
+                errors.put((self.name, item, e))
+                res = None
+            with self._lock:
+                self.busy += time.perf_counter() - start
+                self.items += 1
+            if res is not None:
+                out_queue.put(res)
+
+# Feed items through the stages, yield the outputs of the last stage as they come.
+# Items whose function raised are dropped, (stage name, item, exception) are put in errors
+def run_pipeline(items, stages, queue_size=16, errors=None):
+    errors = errors if errors is not None else queue.Queue()
+    queues = [queue.Queue(queue_size) for _ in range(len(stages)+1)]
+
+    def feed():
+        for item in items:
+            queues[0].put(item)
+        queues[0].put(_DONE)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for stage, in_queue, out_queue in zip(stages, queues[:-1], queues[1:]):
+        stage._running = stage.workers
+        threads += [threading.Thread(target=stage._work, args=(in_queue, out_queue, errors), daemon=True)
+                    for _ in range(stage.workers)]
+    for thread in threads:
+        thread.start()
+    while True:
+        res = queues[-1].get()
+        if res is _DONE:
+            break
+        yield res
+    for thread in threads:
+        thread.join()
+
+# Share of the wall time each stage spent working, per worker: the stage closest to 1 is the bottleneck
+def stage_utilization(stages, seconds):
+    return {stage.name: round(stage.busy / (stage.workers * seconds), 3) for stage in stages}
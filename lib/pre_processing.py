@@ -4,33 +4,76 @@
 #
 ##################################################
 
+import os
+import json
 import numpy as np
 import cv2
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Parameters of my_PreProc, also part of the key of the preprocessed data cache
+PREPROC_PARAMS = {
+    'clahe_clip_limit': 2.0,
+    'clahe_tile_grid_size': (8,8),
+    'gamma': 1.2,
+    'dtype': 'uint8',
+    'compute_dtype': 'float32',
+}
+
+# File of the frozen normalization statistics of the training set, saved in the experiment directory
+NORM_STATS_FILE = 'norm_stats.json'
 
 #My pre processing (use for both training and testing!)
-def my_PreProc(data):
+# Runs on one float32 buffer (gray conversion and normalization, in place) and one
+# uint8 buffer (CLAHE and gamma, in place), so the peak memory is about 5 bytes per pixel.
+# The dataset statistics are computed once, then each image goes through the per-image stages
+# in a pool of num_workers threads (OpenCV and numpy release the GIL) writing into the shared buffers.
+# With norm_stats=(mean, std), e.g. frozen statistics of the training set (see load_norm_stats),
+# every image is processed independently of the others in data.
+# With return_moments=True, the pixel moments (count, mean, M2) of the gray imgs the dataset
+# statistics were computed from are returned too (see save_norm_stats)
+def my_PreProc(data, num_workers=None, norm_stats=None, return_moments=False):
     assert(len(data.shape)==4)
     assert (data.shape[1]==3)  #Use the original images
-    #black-white conversion
-    train_imgs = rgb2gray(data)
-    #my preprocessing:
-    train_imgs = dataset_normalized(train_imgs)
-    train_imgs = clahe_equalized(train_imgs)
-    train_imgs = adjust_gamma(train_imgs, 1.2)
-    train_imgs = train_imgs/255.  #reduce to 0-1 range
+    assert not (return_moments and norm_stats is not None), "the moments of data are not computed with norm_stats"
+    N = data.shape[0]
+    gray_imgs = np.empty((N,1,data.shape[2],data.shape[3]), dtype=np.float32)
+    train_imgs = np.empty(gray_imgs.shape, dtype=np.uint8)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        #black-white conversion
+        list(executor.map(lambda i: rgb2gray(data[i:i+1], out=gray_imgs[i:i+1]), range(N)))
+        stats = dataset_stats(gray_imgs) if norm_stats is None else norm_stats
+        #my preprocessing:
+        list(executor.map(lambda i: preprocess_stages(gray_imgs[i:i+1], stats, out=train_imgs[i:i+1]), range(N)))
+    # kept as uint8 (0-255), scaled to [0,1] per batch when it is fed to the model (see lib.common.to_model_input)
+    if return_moments:
+        imgs_mean, imgs_std = stats
+        return train_imgs, (int(gray_imgs.size), float(imgs_mean), float(imgs_std**2 * gray_imgs.size))
     return train_imgs
 
+# Per-image stages of my_PreProc on gray imgs, given the dataset (mean, std); gray_imgs is overwritten
+def preprocess_stages(gray_imgs, stats, out=None):
+    imgs = dataset_normalized(gray_imgs, out=gray_imgs, stats=stats)
+    imgs = clahe_equalized(imgs, PREPROC_PARAMS['clahe_clip_limit'], PREPROC_PARAMS['clahe_tile_grid_size'], out=out)
+    return adjust_gamma(imgs, PREPROC_PARAMS['gamma'], out=imgs)
+
 #============================================================
 #========= PRE PROCESSING FUNCTIONS ========================#
 #============================================================
 
-#convert RGB image in black and white
-def rgb2gray(rgb):
+#convert RGB image in black and white, as float32
+def rgb2gray(rgb, out=None):
     assert (len(rgb.shape)==4)  #4D arrays
     assert (rgb.shape[1]==3)
-    bn_imgs = rgb[:,0,:,:]*0.299 + rgb[:,1,:,:]*0.587 + rgb[:,2,:,:]*0.114
-    bn_imgs = np.reshape(bn_imgs,(rgb.shape[0],1,rgb.shape[2],rgb.shape[3]))
-    return bn_imgs
+    if out is None:
+        out = np.empty((rgb.shape[0],1,rgb.shape[2],rgb.shape[3]), dtype=np.float32)
+    tmp = np.empty(rgb.shape[2:], dtype=np.float32)
+    # image by image, so the only temporary is one channel of one image
+    for i in range(rgb.shape[0]):
+        np.multiply(rgb[i,0], np.float32(0.299), out=out[i,0])
+        out[i,0] += np.multiply(rgb[i,1], np.float32(0.587), out=tmp)
+        out[i,0] += np.multiply(rgb[i,2], np.float32(0.114), out=tmp)
+    return out
 
 #==== histogram equalization
 def histo_equalized(imgs):
@@ -44,40 +87,96 @@ def histo_equalized(imgs):
 
 # CLAHE (Contrast Limited Adaptive Histogram Equalization)
 #adaptive histogram equalization is used. In this, image is divided into small blocks called "tiles" (tileSize is 8x8 by default in OpenCV). Then each of these blocks are histogram equalized as usual. So in a small area, histogram would confine to a small region (unless there is noise). If noise is there, it will be amplified. To avoid this, contrast limiting is applied. If any histogram bin is above the specified contrast limit (by default 40 in OpenCV), those pixels are clipped and distributed uniformly to other bins before applying histogram equalization. After equalization, to remove artifacts in tile borders, bilinear interpolation is applied
-def clahe_equalized(imgs):
+# Non-uint8 imgs are truncated to uint8 first; the equalization is done in place in that buffer (out if given)
+def clahe_equalized(imgs, clip_limit=2.0, tile_grid_size=(8,8), out=None):
     assert (len(imgs.shape)==4)  #4D arrays
     assert (imgs.shape[1]==1)  #check the channel is 1
     #create a CLAHE object (Arguments are optional).
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    imgs_equalized = np.empty(imgs.shape)
+    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+    if out is None:
+        imgs_equalized = imgs.astype(np.uint8)
+    else:
+        imgs_equalized = out
+        imgs_equalized[...] = imgs
     for i in range(imgs.shape[0]):
-        imgs_equalized[i,0] = clahe.apply(np.array(imgs[i,0], dtype = np.uint8))
+        clahe.apply(imgs_equalized[i,0], dst=imgs_equalized[i,0])
     return imgs_equalized
 
 
 # ===== normalize over the dataset
-def dataset_normalized(imgs):
+# Mean and std of all pixels, accumulated in float64 image by image
+def dataset_stats(imgs):
+    n = imgs[0].size * imgs.shape[0]
+    imgs_mean = sum(img.sum(dtype=np.float64) for img in imgs) / n
+    imgs_var = sum(np.square(img - np.float32(imgs_mean)).sum(dtype=np.float64) for img in imgs) / n
+    return imgs_mean, np.sqrt(imgs_var)
+
+# Pixel moments (count, mean, M2) of one set of imgs, M2 being the sum of squared deviations from the mean
+def image_moments(imgs):
+    mean = imgs.mean(dtype=np.float64)
+    return imgs.size, mean, np.square(imgs - np.float32(mean)).sum(dtype=np.float64)
+
+# Moments of the union of two sets of pixels (parallel form of Welford's algorithm)
+def combine_moments(a, b):
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta**2 * n_a * n_b / n
+
+# moments=None removes the statistics of a previous run, so that they are not used with another training set
+def save_norm_stats(save_path, moments):
+    if moments is None:
+        if os.path.isfile(os.path.join(save_path, NORM_STATS_FILE)):
+            os.remove(os.path.join(save_path, NORM_STATS_FILE))
+        return
+    n, mean, m2 = moments
+    with open(os.path.join(save_path, NORM_STATS_FILE), 'w') as f:
+        json.dump({'mean': float(mean), 'std': float(np.sqrt(m2 / n)), 'count': int(n)}, f, indent=2)
+
+# Frozen (mean, std) saved in save_path by save_norm_stats, None if there are none
+def load_norm_stats(save_path):
+    path = os.path.join(save_path, NORM_STATS_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        stats = json.load(f)
+    return stats['mean'], stats['std']
+
+# Standardized with the dataset mean/std (computed from imgs unless stats=(mean, std) is given),
+# then rescaled to [0,255] per image
+def dataset_normalized(imgs, out=None, stats=None):
     assert (len(imgs.shape)==4)  #4D arrays
     assert (imgs.shape[1]==1)  #check the channel is 1
-    imgs_normalized = np.empty(imgs.shape)
-    imgs_std = np.std(imgs)
-    imgs_mean = np.mean(imgs)
-    imgs_normalized = (imgs-imgs_mean)/imgs_std
-    for i in range(imgs.shape[0]):
-        imgs_normalized[i] = ((imgs_normalized[i] - np.min(imgs_normalized[i])) / (np.max(imgs_normalized[i])-np.min(imgs_normalized[i])))*255
-    return imgs_normalized
+    imgs_mean, imgs_std = dataset_stats(imgs) if stats is None else stats
+    if out is None:
+        out = np.empty(imgs.shape, dtype=np.float32)
+    np.subtract(imgs, np.float32(imgs_mean), out=out)
+    out /= np.float32(imgs_std)
+    imgs_min = out.min(axis=(1,2,3), keepdims=True)
+    imgs_max = out.max(axis=(1,2,3), keepdims=True)
+    out -= imgs_min
+    out *= 255 / (imgs_max - imgs_min)
+    return out
 
 
-def adjust_gamma(imgs, gamma=1.0):
+# Lookup table mapping the pixel values [0, 255] to their adjusted gamma values
+@lru_cache(maxsize=None)
+def gamma_table(gamma):
+    invGamma = 1.0 / gamma
+    table = (((np.arange(0, 256) / 255.0) ** invGamma) * 255).astype("uint8")
+    table.flags.writeable = False
+    return table
+
+
+def adjust_gamma(imgs, gamma=1.0, out=None):
     assert (len(imgs.shape)==4)  #4D arrays
     assert (imgs.shape[1]==1)  #check the channel is 1
-    # build a lookup table mapping the pixel values [0, 255] to
-    # their adjusted gamma values
-    invGamma = 1.0 / gamma
-    table = np.array([((i / 255.0) ** invGamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
     # apply gamma correction using the lookup table
-    new_imgs = np.empty(imgs.shape)
+    table = gamma_table(gamma)
+    if out is None:
+        out = np.empty(imgs.shape, dtype=np.uint8)
     for i in range(imgs.shape[0]):
-        new_imgs[i,0] = cv2.LUT(np.array(imgs[i,0], dtype = np.uint8), table)
-    return new_imgs
+        cv2.LUT(np.asarray(imgs[i,0], dtype=np.uint8), table, dst=out[i,0])
+    return out
 
@@ -0,0 +1,194 @@
+"""
+Dynamic batching of the sliding-window inference of concurrent requests, used by serve.py.
+Each request is cut into overlapping windows (as in lib/inference.py) that are queued; a single
+batching task takes the windows of all pending requests in arrival order, up to max_batch_size
+per forward pass, waiting at most max_queue_delay after the oldest one for the batch to fill up,
+and adds the predictions back into the probability map of their request.
+"""
+import io
+import time
+import base64
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .common import to_model_input
+from .inference import pad_to_windows, window_positions, prune_positions, accumulate
+
+# Decode a base64 encoded image file (png, jpg, tif...) as an [H,W,3] RGB or, for a FOV, [H,W] array
+def decode_image(data, single_channel=False):
+    img = Image.open(io.BytesIO(base64.b64decode(data)))
+    return np.asarray(img.convert('L' if single_channel else 'RGB'))
+
+# Encode an [H,W] uint8 map as a base64 png file
+def encode_png(arr):
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format='PNG')
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+class ServerStats():
+    """Counters of the server, latencies in ms over the last `window` requests"""
+    def __init__(self, window=1000):
+        self.start_time = time.time()
+        self.requests, self.errors = 0, 0
+        self.patches, self.batches = 0, 0
+        self.infer_time = 0.0
+        self.latency = deque(maxlen=window)
+        self.queue_wait = deque(maxlen=window)
+
+    def add_batch(self, n_patches, seconds):
+        self.batches += 1
+        self.patches += n_patches
+        self.infer_time += seconds
+
+    def add_request(self, latency, queue_wait):
+        self.requests += 1
+        self.latency.append(latency * 1000)
+        self.queue_wait.append(queue_wait * 1000)
+
+    def summary(self):
+        uptime = time.time() - self.start_time
+        res = {'uptime_s': uptime, 'requests': self.requests, 'errors': self.errors,
+               'patches': self.patches, 'batches': self.batches,
+               'mean_batch_size': self.patches / max(self.batches, 1),
+               'requests_per_s': self.requests / uptime, 'patches_per_s': self.patches / uptime,
+               'model_busy_ratio': self.infer_time / uptime}
+        for name, values in (('latency_ms', self.latency), ('queue_wait_ms', self.queue_wait)):
+            if values:
+                p50, p95, p99 = np.percentile(values, (50, 95, 99))
+                res[name] = {'mean': round(float(np.mean(values)), 3), 'p50': round(p50, 3), 'p95': round(p95, 3), 'p99': round(p99, 3)}
+        return {k: round(v, 4) if isinstance(v, float) else v for k, v in res.items()}
+
+class _Job():
+    """Windows of one preprocessed image (those with FOV pixels only, if a FOV is given) and the sums of their predictions"""
+    def __init__(self, img, patch_h, patch_w, stride_h, stride_w, future, fov=None):
+        self.img_h, self.img_w = img.shape[1:]
+        img = pad_to_windows(img, patch_h, patch_w, stride_h, stride_w)
+        self.positions = window_positions(img.shape[1], img.shape[2], patch_h, patch_w, stride_h, stride_w)
+        if fov is not None:
+            self.positions = prune_positions(self.positions, fov, img.shape[1], img.shape[2], patch_h, patch_w, stride_h, stride_w)
+        self.windows = np.lib.stride_tricks.sliding_window_view(img, (patch_h, patch_w), axis=(1,2))  # [C,H',W',h,w]
+        self.prob = np.zeros((1,)+img.shape[1:], dtype=np.float32)
+        self.count = np.zeros((1,)+img.shape[1:], dtype=np.float32)
+        self.next = 0  # first window not sent to the model yet
+        self.done = 0
+        self.future = future
+        self.arrival = time.perf_counter()
+        self.first_batch = None
+
+    def take(self, n):
+        pos = self.positions[self.next:self.next+n]
+        self.next += len(pos)
+        return pos, self.windows[:, pos[:,0], pos[:,1]].transpose(1,0,2,3)  # [B,C,h,w]
+
+class DynamicBatcher():
+    """
+    Shares the forward passes of net between concurrent predict() calls. The net runs in
+    a single background thread so the event loop keeps accepting requests meanwhile.
+    """
+    def __init__(self, net, patch_h, patch_w, stride_h, stride_w, device=None,
+                 max_batch_size=64, max_queue_delay=0.005, stats=None):
+        self.net = net
+        self.patch_h, self.patch_w = patch_h, patch_w
+        self.stride_h, self.stride_w = stride_h, stride_w
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_queue_delay = max_queue_delay
+        self.stats = stats if stats is not None else ServerStats()
+        self._jobs = deque()
+        self._pending = 0  # number of queued windows
+        self._wakeup = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    # Forward pass of one [B,C,h,w] batch, vessel probabilities [B,1,h,w]
+    def _forward(self, batch):
+        with torch.no_grad():
+            outputs = self.net(to_model_input(torch.from_numpy(batch), self.device))
+        return outputs[:,1:2].cpu().numpy()
+
+    # One full batch of zeros through the net, so the first requests do not pay for the initialization
+    def warmup(self, in_channels=1, repeat=2):
+        self.net.eval()
+        batch = np.zeros((self.max_batch_size, in_channels, self.patch_h, self.patch_w), dtype=np.uint8)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            self._forward(batch)
+        return (time.perf_counter() - start) / repeat
+
+    # Vessel probability map [1,H,W] of one preprocessed [C,H,W] image, and the time (s) its first
+    # windows waited in the queue. If its [1,H,W] FOV is given, the windows without FOV pixels are skipped
+    async def predict(self, img, fov=None):
+        if self._wakeup is None:
+            raise RuntimeError("DynamicBatcher.run() is not running")
+        job = _Job(np.asarray(img), self.patch_h, self.patch_w, self.stride_h, self.stride_w,
+                   asyncio.get_running_loop().create_future(), fov)
+        if len(job.positions) == 0:  # empty FOV
+            return np.zeros((1, job.img_h, job.img_w), dtype=np.float32), 0.0
+        self._jobs.append(job)
+        self._pending += len(job.positions)
+        self._wakeup.set()
+        await job.future
+        prob = np.divide(job.prob, job.count, out=job.prob, where=job.count>0)
+        return prob[:, :job.img_h, :job.img_w], job.first_batch - job.arrival
+
+    # Windows of the pending jobs, in arrival order, for the next batch
+    def _next_batch(self):
+        parts, batch = [], []
+        n = min(self._pending, self.max_batch_size)
+        self._pending -= n
+        while n > 0:
+            job = self._jobs[0]
+            pos, windows = job.take(n)
+            if job.first_batch is None:
+                job.first_batch = time.perf_counter()
+            parts.append((job, pos))
+            batch.append(windows)
+            n -= len(pos)
+            if job.next == len(job.positions):
+                self._jobs.popleft()
+        return parts, np.ascontiguousarray(np.concatenate(batch))
+
+    # Batching loop, to be run as a task of the event loop serving the requests
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        while True:
+            await self._wakeup.wait()
+            # the oldest queued window waits at most max_queue_delay for the batch to fill up
+            deadline = self._jobs[0].arrival + self.max_queue_delay if self._jobs[0].next == 0 else 0
+            while self._pending < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            parts, batch = self._next_batch()
+            start = time.perf_counter()
+            try:
+                preds = await loop.run_in_executor(self._executor, self._forward, batch)
+            except Exception as e:
+                for job, _ in parts:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                    if job in self._jobs:  # its remaining windows are dropped
+                        self._jobs.remove(job)
+                        self._pending -= len(job.positions) - job.next
+                preds = None
+            self.stats.add_batch(len(batch), time.perf_counter() - start)
+            if preds is not None:
+                start = 0
+                for job, pos in parts:
+                    accumulate(job.prob, job.count, preds[start:start+len(pos)], pos)
+                    start += len(pos)
+                    job.done += len(pos)
+                    if job.done == len(job.positions) and not job.future.done():
+                        job.future.set_result(None)
+            if not self._jobs:
+                self._wakeup.clear()
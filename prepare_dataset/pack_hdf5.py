@@ -0,0 +1,48 @@
+# =========================================================
+#
+#   Pack a data path list into one chunked, compressed HDF5 file
+#   of preprocessed imgs, GTs and FOVs. Run from the root directory
+#   of the project, e.g.
+#   python ./prepare_dataset/pack_hdf5.py --data_path_list ./prepare_dataset/data_path_list/DRIVE/train.txt
+#
+#   The .h5 file can then be used as --train_data_path_list or --test_data_path_list
+# =========================================================
+import sys
+sys.path.append('./')  # The root directory of the project
+import argparse
+from os.path import splitext
+
+from lib.extract_patches import load_file_path_txt, load_preprocessed_data, dataset_moments
+from lib.pre_processing import PREPROC_PARAMS
+from lib.h5_dataset import write_hdf5
+
+
+# The normalization moments of the original imgs are stored as an attribute, so training
+# on the file can save the normalization statistics even without the original imgs
+def pack_hdf5(data_path_list, h5_path, chunk_size=64, compression='gzip', keep_original=True):
+    names = ['imgs', 'masks', 'fovs', 'ori_imgs']
+    arrays = dict(zip(names, load_preprocessed_data(data_path_list, keep_original=True)))
+    ori_imgs = arrays['ori_imgs'] if keep_original else arrays.pop('ori_imgs')
+    img_list, _, _ = load_file_path_txt(data_path_list)
+    attrs = {'data_path_list': data_path_list, 'img_paths': img_list, 'preproc': PREPROC_PARAMS,
+             'norm_moments': dataset_moments(lambda i: ori_imgs[i:i+1], len(ori_imgs))}
+    write_hdf5(h5_path, arrays, attrs, chunk_size=chunk_size, compression=compression)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path_list', required=True,
+                        help='path list file (.txt) of the data set')
+    parser.add_argument('--out', default=None,
+                        help='output HDF5 file, next to the path list by default')
+    parser.add_argument('--chunk_size', default=64, type=int,
+                        help='side length of the square chunks')
+    parser.add_argument('--compression', default='gzip', choices=['gzip', 'lzf'])
+    parser.add_argument('--no_original', action='store_true',
+                        help='do not store the original imgs: training and testing work without them, '
+                             'but test.py then cannot save the segmentation result images')
+    args = parser.parse_args()
+
+    out = args.out or splitext(args.data_path_list)[0] + '.h5'
+    pack_hdf5(args.data_path_list, out, args.chunk_size, args.compression, keep_original=not args.no_original)
+    print("Packed {} into {}".format(args.data_path_list, out))
@@ -0,0 +1,121 @@
+# =========================================================
+#
+#   Write the train.txt/test.txt data path lists of a data set, after checking
+#   in parallel that every image/GT/FOV triple can be decoded and has matching
+#   shapes and valid value ranges. A manifest (sizes, dims, value ranges and
+#   content hashes of the files) is written next to each list, e.g.
+#   python ./prepare_dataset/prepare.py --dataset DRIVE
+#
+# =========================================================
+import sys
+sys.path.append('./')  # The root directory of the project
+import os
+import argparse
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.extract_patches import read_array
+from lib.data_manifest import file_record, write_manifest
+
+# Directories of imgs, GTs and FOVs relative to the data root, either per split or
+# for the whole data set with the (start, end) index range of the test imgs
+DATASETS = {
+    'DRIVE': {'train': ("DRIVE/training/images/", "DRIVE/training/1st_manual/", "DRIVE/training/mask/"),
+              'test': ("DRIVE/test/images/", "DRIVE/test/1st_manual/", "DRIVE/test/mask/")},
+    'STARE': {'all': ("STARE/images", "STARE/1st_labels_ah", "STARE/mask"), 'test_range': (0, 5)},
+    'CHASEDB1': {'all': ("CHASEDB1/images", "CHASEDB1/1st_label", "CHASEDB1/mask"), 'test_range': (0, 7)},
+}
+
+
+def get_path_list(data_root_path, img_path, label_path, fov_path):
+    res = []
+    for path in (img_path, label_path, fov_path):
+        data_path = join(data_root_path, path)
+        filename_list = sorted(os.listdir(data_path))
+        res.append([join(data_path, j) for j in filename_list])
+    if not len(res[0]) == len(res[1]) == len(res[2]):
+        raise ValueError("Different numbers of imgs ({}), GTs ({}) and FOVs ({}) in {}".format(
+            len(res[0]), len(res[1]), len(res[2]), (img_path, label_path, fov_path)))
+    return res
+
+
+def write_path_list(name_list, save_path, file_name):
+    with open(join(save_path, file_name), 'w') as f:
+        for i in range(len(name_list[0])):
+            f.write(str(name_list[0][i]) + " " + str(name_list[1][i]) + " " + str(name_list[2][i]) + '\n')
+    return join(save_path, file_name)
+
+
+# Decode and check one img/GT/FOV triple, return its manifest record and the list of problems
+def check_sample(img_path, gt_path, fov_path):
+    try:
+        img = read_array(img_path)
+        gt = read_array(gt_path, single_channel=True)
+        fov = read_array(fov_path, single_channel=True)
+    except Exception as e:
+        return None, ["cannot decode {}: {}".format((img_path, gt_path, fov_path), e)]
+    errors = []
+    if len(img.shape) != 3:
+        errors.append("{} is not a color image, shape {}".format(img_path, img.shape))
+    if gt.shape != img.shape[:2] or fov.shape != img.shape[:2]:
+        errors.append("shapes of {} {}, {} {} and {} {} do not match".format(
+            img_path, img.shape, gt_path, gt.shape, fov_path, fov.shape))
+    if not (gt.min() == 0 and gt.max() in (1, 255)):
+        errors.append("GT {} values should be 0 and 1 or 255, got range {}-{}".format(gt_path, gt.min(), gt.max()))
+    if not (fov.min() == 0 and fov.max() == 255):
+        errors.append("FOV {} values should be 0 and 255, got range {}-{}".format(fov_path, fov.min(), fov.max()))
+    record = {'img': file_record(img_path, img), 'gt': file_record(gt_path, gt), 'fov': file_record(fov_path, fov)}
+    return record, errors
+
+
+# Check all samples of a path list in parallel, raise if any of them is invalid
+def check_path_list(name_list, num_workers=None):
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = list(executor.map(check_sample, *name_list))
+    errors = [e for _, errs in results for e in errs]
+    shapes = {tuple(record['img']['shape']) for record, _ in results if record is not None}
+    if len(shapes) > 1:
+        errors.append("imgs have different shapes {}".format(sorted(shapes)))
+    if errors:
+        raise ValueError("\033[0;31mInvalid data set:\n  {}\033[0m".format("\n  ".join(errors)))
+    return [record for record, _ in results]
+
+
+def write_split(name_list, save_path, file_name, num_workers=None):
+    samples = check_path_list(name_list, num_workers)
+    data_path_list = write_path_list(name_list, save_path, file_name)
+    write_manifest(data_path_list, samples)
+    print('Number of {} imgs: {}, shape: {}'.format(file_name.split('.')[0], len(samples), samples[0]['img']['shape'] if samples else None))
+
+
+def prepare(dataset, data_root_path='./datasets/', save_path=None, num_workers=None):
+    layout = DATASETS[dataset]
+    save_path = save_path or join("./prepare_dataset/data_path_list", dataset)
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    if 'all' in layout:
+        data_list = get_path_list(data_root_path, *layout['all'])
+        print('Numbers of all imgs:', len(data_list[0]))
+        start, end = layout['test_range']  # 测试集索引范围，左闭右开
+        train_list = [data_list[i][:start] + data_list[i][end:] for i in range(len(data_list))]
+        test_list = [data_list[i][start:end] for i in range(len(data_list))]
+    else:
+        train_list = get_path_list(data_root_path, *layout['train'])
+        test_list = get_path_list(data_root_path, *layout['test'])
+    write_split(train_list, save_path, 'train.txt', num_workers)
+    write_split(test_list, save_path, 'test.txt', num_workers)
+    print("Finish!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', required=True, choices=sorted(DATASETS))
+    parser.add_argument('--data_root', default='./datasets/',
+                        help='root directory of the data sets')
+    parser.add_argument('--save_path', default=None,
+                        help='output directory of the path lists, ./prepare_dataset/data_path_list/<dataset> by default')
+    parser.add_argument('--num_workers', default=None, type=int,
+                        help='number of threads decoding and checking the files')
+    args = parser.parse_args()
+
+    prepare(args.dataset, args.data_root, args.save_path, args.num_workers)
@@ -0,0 +1,156 @@
+"""
+Bulk segmentation of a directory (searched recursively) or glob pattern of fundus images, without GT, e.g.
+    python segment.py --save UNet_vessel_seg --input_images "/data/screening/**/*.jpg" --output_dir /data/vessels
+For every image <name>.<ext>, <name>.<ext>_prob.png (vessel probability x255) and <name>.<ext>_bin.png
+(thresholded at --threshold) are written to output_dir, keeping the sub-directories of the input.
+Decoding, preprocessing, inference and writing are concurrent stages connected by bounded
+queues (see lib/pipeline.py), so the model is kept busy while the next images are read.
+The outputs are written atomically and recorded in output_dir/segment_manifest.jsonl:
+a rerun skips the images whose outputs already exist.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import queue
+from os.path import join
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+from tqdm import tqdm
+from PIL import Image
+
+import models
+from config import parse_args
+from lib.common import setpu_seed, readImg
+from lib.pre_processing import my_PreProc, load_norm_stats
+from lib.inference import sliding_window_predict, WholeImagePredictor
+from lib.pipeline import Stage, run_pipeline, stage_utilization
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif', '.ppm')
+MANIFEST_FILE = 'segment_manifest.jsonl'
+
+# Image files of a directory (recursively) or a glob pattern, with their paths relative to the input root
+def list_images(input_images):
+    if os.path.isdir(input_images):
+        root = input_images
+        paths = [join(d, f) for d, _, files in os.walk(root) for f in files]
+    else:
+        paths = glob.glob(input_images, recursive=True)
+        root = os.path.commonpath([os.path.dirname(p) for p in paths]) if paths else ''
+    paths = sorted(p for p in paths if p.lower().endswith(IMG_EXTENSIONS))
+    return [(p, os.path.relpath(p, root)) for p in paths]
+
+# The source extension is kept in the output names, so that a.png and a.jpg do not overwrite each other
+def output_paths(output_dir, rel_path):
+    stem = join(output_dir, rel_path)
+    return stem + '_prob.png', stem + '_bin.png'
+
+# Write a png to a temporary file first, so an existing output is always complete
+def save_png_atomic(arr, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(arr).save(path + '.tmp', format='PNG')
+    os.replace(path + '.tmp', path)
+
+class Segmenter():
+    """Stages of the bulk segmentation, items are dicts carrying the image through the pipeline"""
+    def __init__(self, net, args, device=None, norm_stats=None):
+        self.args = args
+        self.net = net
+        self.device = device
+        self.norm_stats = norm_stats
+        self.whole = WholeImagePredictor(net, device, args.tile_size, args.in_channels) if args.test_mode == 'whole' else None
+
+    def decode(self, item):
+        item['img'] = np.asarray(readImg(item['input']).convert('RGB'))
+        return item
+
+    def preprocess(self, item):
+        img = item.pop('img')
+        item['shape'] = list(img.shape[:2])
+        item['img'] = my_PreProc(np.transpose(img, (2,0,1))[None], num_workers=1, norm_stats=self.norm_stats)[0]
+        return item
+
+    def infer(self, item):
+        img = item.pop('img')
+        if self.whole is not None:
+            item['prob'] = self.whole(img)[0]
+        else:
+            item['prob'] = sliding_window_predict(
+                self.net, img, int(self.args.test_patch_height), int(self.args.test_patch_width),
+                int(self.args.stride_height), int(self.args.stride_width), self.args.batch_size, self.device)[0]
+        return item
+
+    def write(self, item):
+        prob = item.pop('prob')
+        prob_path, bin_path = item['outputs']
+        save_png_atomic(np.round(prob * 255).astype(np.uint8), prob_path)
+        save_png_atomic(((prob >= self.args.threshold) * 255).astype(np.uint8), bin_path)
+        item['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        return item
+
+    def stages(self, io_workers, preproc_workers):
+        return [Stage('decode', self.decode, io_workers),
+                Stage('preprocess', self.preprocess, preproc_workers),
+                Stage('infer', self.infer, 1),
+                Stage('write', self.write, io_workers)]
+
+def load_segmented(manifest_file):
+    if not os.path.isfile(manifest_file):
+        return set()
+    with open(manifest_file, 'r') as f:
+        return {json.loads(line)['input'] for line in f if line.strip()}
+
+if __name__ == '__main__':
+    setpu_seed(2021)
+    args = parse_args()
+    if args.input_images is None:
+        sys.exit("--input_images is required")
+    save_path = join(args.outf, args.save)
+    output_dir = args.output_dir or join(save_path, 'segmentation')
+    os.makedirs(output_dir, exist_ok=True)
+    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+    print('The computing device used is: ','GPU' if device.type=='cuda' else 'CPU')
+
+    # resume: images whose outputs exist are skipped, and recorded if they were not yet
+    manifest_file = join(output_dir, MANIFEST_FILE)
+    segmented = load_segmented(manifest_file)
+    todo, skipped = [], 0
+    with open(manifest_file, 'a') as manifest:
+        for path, rel_path in list_images(args.input_images):
+            outputs = output_paths(output_dir, rel_path)
+            if all(os.path.isfile(p) for p in outputs):
+                skipped += 1
+                if path not in segmented:
+                    manifest.write(json.dumps({'input': path, 'outputs': outputs}) + '\n')
+            else:
+                todo.append({'input': path, 'outputs': outputs})
+    print('\033[0;33m{} images to segment, {} already done in {}\033[0m'.format(len(todo), skipped, output_dir))
+
+    net = models.LadderNet(inplanes=args.in_channels, num_classes=args.classes, layers=3, filters=16).to(device)
+    cudnn.benchmark = True
+    print('==> Loading checkpoint...')
+    checkpoint = torch.load(join(save_path, 'best_model.pth'), map_location=device)
+    net.load_state_dict(checkpoint['net'])
+    net.eval()
+    norm_stats = load_norm_stats(save_path)
+    if norm_stats is None:
+        print("\033[0;31mNo normalization statistics in {}, each image is normalized with its own\033[0m".format(save_path))
+
+    segmenter = Segmenter(net, args, device, norm_stats)
+    stages = segmenter.stages(args.io_workers, args.preproc_workers or os.cpu_count())
+    errors = queue.Queue()
+    start, done = time.time(), 0
+    with open(manifest_file, 'a') as manifest:
+        for item in tqdm(run_pipeline(todo, stages, args.queue_size, errors), total=len(todo)):
+            manifest.write(json.dumps(item) + '\n')
+            manifest.flush()
+            done += 1
+    seconds = time.time() - start
+    while not errors.empty():
+        stage, item, e = errors.get()
+        print("\033[0;31m{} failed at {}: {}\033[0m".format(item['input'], stage, e))
+    print('Segmented {} images in {:.1f}s, stage utilization: {}'.format(
+        done, seconds, stage_utilization(stages, max(seconds, 1e-6))))
@@ -0,0 +1,175 @@
+"""
+Local HTTP inference server, e.g.
+    python serve.py --save UNet_vessel_seg --port 8000 --max_batch_size 64 --max_queue_delay 5
+The best_model.pth of the experiment is loaded once and warmed up. Endpoints:
+    POST /predict  {"image": <base64 image file>, "fov": <base64 FOV file, optional>,
+                    "threshold": 0.5, "outputs": ["prob", "binary"]}
+                -> {"height", "width", "prob": <base64 png>, "binary": <base64 png>, "latency_ms", "queue_wait_ms"}
+    GET  /stats    latency and throughput counters
+    GET  /health
+The images are preprocessed with the frozen normalization statistics of the training set, and the
+windows of concurrent requests are predicted in shared batches (see lib/serving.py).
+Pixels outside the FOV, if one is given, are set to 0.
+"""
+import json
+import time
+import asyncio
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+
+import models
+from config import parse_args
+from lib.common import setpu_seed
+from lib.pre_processing import my_PreProc, load_norm_stats
+from lib.serving import DynamicBatcher, ServerStats, decode_image, encode_png
+
+MAX_BODY_BYTES = 64 * 1024**2
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+class InferenceServer():
+    """HTTP/1.1 front end of a DynamicBatcher, on asyncio streams"""
+    def __init__(self, net, args, device=None, norm_stats=None):
+        self.args = args
+        self.norm_stats = norm_stats
+        self.stats = ServerStats()
+        self.batcher = DynamicBatcher(
+            net, int(args.test_patch_height), int(args.test_patch_width),
+            int(args.stride_height), int(args.stride_width), device,
+            max_batch_size=args.max_batch_size, max_queue_delay=args.max_queue_delay/1000, stats=self.stats)
+        # decoding and preprocessing release the GIL, they run beside the event loop
+        self.executor = ThreadPoolExecutor(max_workers=args.preproc_workers)
+
+    # Decoded and preprocessed [1,H,W] image and [H,W] FOV (or None) of a request
+    def preprocess(self, request):
+        img = decode_image(request['image'])
+        fov = decode_image(request['fov'], single_channel=True) if request.get('fov') else None
+        if fov is not None and fov.shape != img.shape[:2]:
+            raise ValueError("FOV shape {} does not match image shape {}".format(fov.shape, img.shape[:2]))
+        img = my_PreProc(np.transpose(img, (2,0,1))[None], num_workers=1, norm_stats=self.norm_stats)[0]
+        return img, fov
+
+    def postprocess(self, prob, fov, request):
+        threshold = float(request.get('threshold', self.args.threshold))
+        outputs = request.get('outputs', ['prob', 'binary'])
+        prob = prob[0]
+        if fov is not None:
+            prob[fov == 0] = 0
+        res = {'height': prob.shape[0], 'width': prob.shape[1]}
+        if 'prob' in outputs:
+            res['prob'] = encode_png(np.round(prob * 255).astype(np.uint8))
+        if 'binary' in outputs:
+            res['binary'] = encode_png(((prob >= threshold) * 255).astype(np.uint8))
+        return res
+
+    async def predict(self, request):
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        img, fov = await loop.run_in_executor(self.executor, self.preprocess, request)
+        prune = fov is not None and self.args.prune_test_patches
+        prob, queue_wait = await self.batcher.predict(img, fov[None] if prune else None)
+        res = await loop.run_in_executor(self.executor, self.postprocess, prob, fov, request)
+        latency = time.perf_counter() - start
+        self.stats.add_request(latency, queue_wait)
+        res.update(latency_ms=round(latency*1000, 3), queue_wait_ms=round(queue_wait*1000, 3))
+        return res
+
+    async def route(self, method, path, body):
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path == '/stats':
+            return 200, self.stats.summary()
+        if path != '/predict':
+            return 404, {'error': 'unknown path {}'.format(path)}
+        if method != 'POST':
+            return 405, {'error': 'use POST for /predict'}
+        try:
+            request = json.loads(body)
+            if 'image' not in request:
+                raise ValueError("missing 'image'")
+        except ValueError as e:
+            return 400, {'error': 'invalid request: {}'.format(e)}
+        try:
+            return 200, await self.predict(request)
+        except (ValueError, OSError) as e:  # undecodable image, bad FOV...
+            return 400, {'error': str(e)}
+
+    # Serve the requests of one connection, kept alive until the client closes it
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_BYTES:
+                    status, res = 413, {'error': 'request larger than {} bytes'.format(MAX_BODY_BYTES)}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    try:
+                        status, res = await self.route(method, path.split('?')[0], body)
+                    except Exception as e:
+                        status, res = 500, {'error': repr(e)}
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if status != 200:
+                    self.stats.errors += 1
+                payload = json.dumps(res).encode()
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, HTTP_STATUS[status], len(payload), 'keep-alive' if keep_alive else 'close').encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass  # client went away or sent garbage
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        batching = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print('\033[0;32mServing on http://{}:{} (max batch size {}, max queue delay {} ms)\033[0m'.format(
+            host, port, self.args.max_batch_size, self.args.max_queue_delay))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batching.cancel()
+
+if __name__ == '__main__':
+    setpu_seed(2021)
+    args = parse_args()
+    save_path = join(args.outf, args.save)
+    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+    print('The computing device used is: ','GPU' if device.type=='cuda' else 'CPU')
+
+    net = models.LadderNet(inplanes=args.in_channels, num_classes=args.classes, layers=3, filters=16).to(device)
+    cudnn.benchmark = True
+
+    print('==> Loading checkpoint...')
+    checkpoint = torch.load(join(save_path, 'best_model.pth'), map_location=device)
+    net.load_state_dict(checkpoint['net'])
+    net.eval()
+
+    norm_stats = load_norm_stats(save_path)
+    if norm_stats is None:
+        print("\033[0;31mNo normalization statistics in {}, each image is normalized with its own\033[0m".format(save_path))
+
+    server = InferenceServer(net, args, device, norm_stats)
+    print('Warmup: {:.1f} ms per batch of {} patches'.format(server.batcher.warmup(args.in_channels)*1000, args.max_batch_size))
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print('Stopped, final stats: {}'.format(server.stats.summary()))
@@ -1,6 +1,5 @@
 import joblib,copy
 import torch.backends.cudnn as cudnn
-from torch.utils.data import DataLoader
 import torch,sys
 from tqdm import tqdm
 
@@ -11,55 +10,91 @@ import argparse
 from lib.logger import Logger, Print_Logger
 from lib.extract_patches import *
 from os.path import join
-from lib.dataset import TestDataset
 from lib.metrics import Evaluate
+from lib.inference import sliding_window_predict, WholeImagePredictor
 import models
-from lib.common import setpu_seed,dict_round
+from lib.common import setpu_seed,dict_round,to_model_input
 from config import parse_args
-from lib.pre_processing import my_PreProc
+from lib.pre_processing import my_PreProc, load_norm_stats
 
 setpu_seed(2021)
 
 class Test():
-    def __init__(self, args):
+    """
+    args.test_mode 'patch' extracts the overlapping patches of the whole test set and recomposes
+    all predictions at the end, 'stream' predicts the windows of one image at a time and
+    accumulates them into its probability map right away (no patch predictions are stored, but
+    the preprocessed and original test imgs and pred_imgs [N,1,H,W] are), 'whole' runs the (fully convolutional)
+    net on each whole image in one pass, or in tiles of args.tile_size if it runs out of memory.
+    With args.prune_test_patches, the patch and stream modes skip the windows without FOV pixels.
+    The inputs are batched in the calling process and sent to device (by default, the GPU
+    if args.cuda and one is available, else the CPU), the net must be on the same device.
+    """
+    def __init__(self, args, device=None):
         self.args = args
+        self.device = device if device is not None else torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
         assert (args.stride_height <= args.test_patch_height and args.stride_width <= args.test_patch_width)
         # save path
         self.path_experiment = join(args.outf, args.save)
-
-        self.patches_imgs_test, self.test_imgs, self.test_masks, self.test_FOVs, self.new_height, self.new_width = get_data_test_overlap(
-            test_data_path_list=args.test_data_path_list,
-            patch_height=args.test_patch_height,
-            patch_width=args.test_patch_width,
-            stride_height=args.stride_height,
-            stride_width=args.stride_width
-        )
-        self.img_height = self.test_imgs.shape[2]
-        self.img_width = self.test_imgs.shape[3]
-
-        test_set = TestDataset(self.patches_imgs_test)
-        self.test_loader = DataLoader(test_set, batch_size=args.batch_size, shuffle=False, num_workers=3)
-
-    # Inference prediction process
+        # frozen normalization statistics of the training set, so each test image is preprocessed on its own
+        norm_stats = load_norm_stats(self.path_experiment)
+        if norm_stats is None:
+            print("\033[0;31mNo normalization statistics in {}, the test set is normalized with its own\033[0m".format(self.path_experiment))
+
+        if args.test_mode == 'patch':
+            self.patches_imgs_test, self.test_imgs, self.test_masks, self.test_FOVs, self.new_height, self.new_width = get_data_test_overlap(
+                test_data_path_list=args.test_data_path_list,
+                patch_height=args.test_patch_height,
+                patch_width=args.test_patch_width,
+                stride_height=args.stride_height,
+                stride_width=args.stride_width,
+                cache_dir=args.cache_dir,
+                num_workers=args.preproc_workers,
+                norm_stats=norm_stats,
+                prune=args.prune_test_patches
+            )
+        else:
+            # preprocessed full images, the windows are cut per image at inference
+            self.imgs_test, self.test_masks, self.test_FOVs, self.test_imgs = load_preprocessed_data(
+                args.test_data_path_list, args.cache_dir, keep_original=True,
+                num_workers=args.preproc_workers, norm_stats=norm_stats)
+        # test_imgs (the original imgs) is None if a HDF5 test set was packed without them
+        self.img_height = self.test_masks.shape[2]
+        self.img_width = self.test_masks.shape[3]
+
+    # Inference prediction process, sets the predicted probability maps pred_imgs [N,1,H,W]
     def inference(self, net):
         net.eval()
-        preds = []
+        if self.args.test_mode == 'whole':
+            predictor = WholeImagePredictor(net, self.device, self.args.tile_size, self.args.in_channels)
+            self.pred_imgs = np.empty((self.test_masks.shape[0], 1, self.img_height, self.img_width))
+            for i in tqdm(range(self.test_masks.shape[0])):
+                self.pred_imgs[i] = predictor(self.imgs_test[i])
+            return
+        if self.args.test_mode == 'stream':
+            self.pred_imgs = np.empty((self.test_masks.shape[0], 1, self.img_height, self.img_width))
+            for i in tqdm(range(self.test_masks.shape[0])):
+                self.pred_imgs[i] = sliding_window_predict(
+                    net, self.imgs_test[i], int(self.args.test_patch_height), int(self.args.test_patch_width),
+                    int(self.args.stride_height), int(self.args.stride_width), self.args.batch_size, self.device,
+                    fov=self.test_FOVs[i] if self.args.prune_test_patches else None)
+            return
+        # batches are sliced from the patch view in this process, no loader workers to start
+        N_patches, batch_size = len(self.patches_imgs_test), self.args.batch_size
+        self.pred_patches = np.empty((N_patches,1)+self.patches_imgs_test.shape[2:], dtype=np.float32)
         with torch.no_grad():
-            for batch_idx, inputs in tqdm(enumerate(self.test_loader), total=len(self.test_loader)):
-                inputs = inputs.cuda()
-                outputs = net(inputs)
-                outputs = outputs[:,1].data.cpu().numpy()
-                preds.append(outputs)
-        predictions = np.concatenate(preds, axis=0)
-        self.pred_patches = np.expand_dims(predictions,axis=1)
-        
-    # Evaluate ate and visualize the predicted images
-    def evaluate(self):
+            for start in tqdm(range(0, N_patches, batch_size)):
+                inputs = torch.from_numpy(np.ascontiguousarray(self.patches_imgs_test[start:start+batch_size]))
+                outputs = net(to_model_input(inputs, self.device))
+                self.pred_patches[start:start+batch_size] = outputs[:,1:2].cpu().numpy()
         self.pred_imgs = recompone_overlap(
-            self.pred_patches, self.new_height, self.new_width, self.args.stride_height, self.args.stride_width)
+            self.pred_patches, self.new_height, self.new_width, self.args.stride_height, self.args.stride_width,
+            keep=self.patches_imgs_test.keep)
         ## restore to original dimensions
         self.pred_imgs = self.pred_imgs[:, :, 0:self.img_height, 0:self.img_width]
 
+    # Evaluate ate and visualize the predicted images
+    def evaluate(self):
         #predictions only inside the FOV
         y_scores, y_true = pred_only_in_FOV(self.pred_imgs, self.test_masks, self.test_FOVs)
         eval = Evaluate(save_path=self.path_experiment)
@@ -71,8 +106,10 @@ class Test():
 
     # save segmentation imgs
     def save_segmentation_result(self):
-        img_path_list, _, _ = load_file_path_txt(self.args.test_data_path_list)
-        img_name_list = [item.split('/')[-1].split('.')[0] for item in img_path_list]
+        if self.test_imgs is None:
+            print("\033[0;31mNo original test imgs, the segmentation results are not saved\033[0m")
+            return
+        img_name_list = load_img_names(self.args.test_data_path_list)
 
         kill_border(self.pred_imgs, self.test_FOVs) # only for visualization
         self.save_img_path = join(self.path_experiment,'result_img')
@@ -85,15 +122,9 @@ class Test():
 
     # Val on the test set at each epoch
     def val(self):
-        self.pred_imgs = recompone_overlap(
-            self.pred_patches, self.new_height, self.new_width, self.args.stride_height, self.args.stride_width)
-        ## recover to original dimensions
-        self.pred_imgs = self.pred_imgs[:, :, 0:self.img_height, 0:self.img_width]
-
         #predictions only inside the FOV
-        y_scores, y_true = pred_only_in_FOV(self.pred_imgs, self.test_masks, self.test_FOVs)
         eval = Evaluate(save_path=self.path_experiment)
-        eval.add_batch(y_true, y_scores)
+        eval.add_batch(self.test_masks, self.pred_imgs, mask=FOV_mask(self.test_FOVs, self.pred_imgs.shape)[:,None])
         confusion,accuracy,specificity,sensitivity,precision = eval.confusion_matrix()
         log = OrderedDict([('val_auc_roc', eval.auc_roc()),
                            ('val_f1', eval.f1_score()),
@@ -115,10 +146,10 @@ if __name__ == '__main__':
 
     # Load checkpoint
     print('==> Loading checkpoint...')
-    checkpoint = torch.load(join(save_path, 'best_model.pth'))
+    checkpoint = torch.load(join(save_path, 'best_model.pth'), map_location=device)
     net.load_state_dict(checkpoint['net'])
 
-    eval = Test(args)
+    eval = Test(args, device)
     eval.inference(net)
     print(eval.evaluate())
     eval.save_segmentation_result()
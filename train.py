@@ -10,7 +10,11 @@ from lib.logger import Logger, Print_Logger
 import models
 from test import Test
 
-from function import get_dataloader, train, val, get_dataloaderV2
+from function import get_dataloader, train, val, get_dataloaderV2, get_dataloader_stream
+from lib.dataset import BatchAugment
+from lib.extract_patches import compute_norm_stats
+from lib.h5_dataset import is_hdf5
+from lib.pre_processing import save_norm_stats
 
 
 def main():
@@ -38,7 +42,7 @@ def main():
     if args.pre_trained is not None:
         # Load checkpoint.
         print('==> Resuming from checkpoint..')
-        checkpoint = torch.load(args.outf + '%s/latest_model.pth' % args.pre_trained)
+        checkpoint = torch.load(args.outf + '%s/latest_model.pth' % args.pre_trained, map_location=device)
         net.load_state_dict(checkpoint['net'])
         optimizer.load_state_dict(checkpoint['optimizer'])
         args.start_epoch = checkpoint['epoch']+1
@@ -51,12 +55,20 @@ def main():
     # lr_scheduler = optim.lr_scheduler.StepLR(optimizer,step_size=10,gamma=0.5)
     lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.N_epochs, eta_min=0)
     
-    train_loader, val_loader = get_dataloaderV2(args) # create dataloader
-    # train_loader, val_loader = get_dataloader(args)
+    get_loaders = {'V1': get_dataloader, 'V2': get_dataloaderV2, 'stream': get_dataloader_stream}[args.dataloader]
+    train_loader, val_loader = get_loaders(args) # create dataloader
+    # frozen normalization statistics of the training set, used to preprocess the test imgs
+    # (kept from the preprocessing of the training set, so this does not decode the imgs again)
+    if args.dataloader == 'V2' and args.lazy_images and not is_hdf5(args.train_data_path_list):
+        # the lazy image store normalizes every img with its own statistics, there are none to freeze
+        save_norm_stats(save_path, None)
+    else:
+        save_norm_stats(save_path, compute_norm_stats(args.train_data_path_list, args.preproc_workers, args.cache_dir))
+    batch_aug = BatchAugment(crop_shape=(48, 48), generator=torch.Generator().manual_seed(2021)) if args.batch_aug else None
     
     if args.val_on_test: 
         print('\033[0;32m===============Validation on Testset!!!===============\033[0m')
-        val_tool = Test(args) 
+        val_tool = Test(args, device) 
 
     best = {'epoch':0,'AUC_roc':0.5} # Initialize the best epoch and performance(AUC of ROC)
     trigger = 0  # Early stop Counter
@@ -65,7 +77,9 @@ def main():
             (epoch, args.N_epochs,optimizer.state_dict()['param_groups'][0]['lr'], time.asctime()))
         
         # train stage
-        train_log = train(train_loader,net,criterion, optimizer,device) 
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch) # reseed the augmentation of each loader worker
+        train_log = train(train_loader,net,criterion, optimizer,device,batch_aug) 
         # val stage
         if not args.val_on_test:
             val_log = val(val_loader,net,criterion,device)